@@ -6,8 +6,12 @@
 """
 
 import os
+import threading
+from queue import Empty, Queue
 from time import time
 
+from ..util.archive import FileNameIndex
+from ..util.cache import ConversionCache
 from ..util.config import (
     config_increment,
     config_save,
@@ -24,9 +28,11 @@ from ..util.logger import (
     print_err,
     set_debug_mode,
 )
+from ..util.metrics import run_metrics
 from ..util.parser import (
+    get_moz_file_paths,
     get_tiger_files,
-    load_moz_files,
+    load_moz_file,
     write_tiger_file,
 )
 
@@ -50,9 +56,13 @@ from .viewer import WinViewer
 
 class WinMain(tk.Tk):
     default_theme = 'clam'
+    # Milliseconds between checks for conversion progress.
+    progress_poll_ms = 100
 
-    def __init__(self, *, run_function=None, **kwargs):
+    def __init__(self, *, run_function=None, save_config=True, **kwargs):
         self.run_function = run_function or None
+        # Whether settings are saved to config when the window is closed.
+        self.save_config = save_config
         self.settings = {k: v for k, v in kwargs.items()}
         # Don't send WinMain kwargs to Tk.
         super().__init__()
@@ -100,6 +110,13 @@ class WinMain(tk.Tk):
         # A singleton instance for the Tiger Viewer window (WinViewer).
         self.win_viewer = None
 
+        # Background conversion thread, set in `cmd_btn_run()`.
+        self.conversion_thread = None
+        # Messages from the conversion thread, for `poll_conversion()`.
+        self.conversion_queue = None
+        # Set to cancel the conversion thread.
+        self.conversion_cancel = None
+
         # Hotkey and Menu information for this window, programmatically setup.
         # They are first sorted by label, and then by 'order' (if available).
         hotkeys = {
@@ -375,6 +392,43 @@ class WinMain(tk.Tk):
             ipady=8,
         )
 
+        # Progress bar and Cancel button, shown while running.
+        self.frm_progress = ttk.Frame(self.frm_cmds)
+        self.var_progress = tk.StringVar()
+        self.lbl_progress = ttk.Label(
+            self.frm_progress,
+            textvariable=self.var_progress,
+        )
+        self.lbl_progress.pack(
+            side=tk.TOP,
+            fill=tk.X,
+            expand=True,
+            padx=2,
+        )
+        self.prg_run = ttk.Progressbar(
+            self.frm_progress,
+            mode='determinate',
+        )
+        self.prg_run.pack(
+            side=tk.LEFT,
+            fill=tk.X,
+            expand=True,
+            padx=2,
+        )
+        self.btn_cancel = ttk.Button(
+            self.frm_progress,
+            text='Cancel',
+            underline=0,
+            width=6,
+            command=self.cmd_btn_cancel,
+        )
+        self.btn_cancel.pack(
+            side=tk.RIGHT,
+            fill=tk.NONE,
+            expand=False,
+            padx=2,
+        )
+
         # Bind hotkeys for buttons.
         for btninfo in hotkeys['btns'].values():
             self.bind_all(
@@ -499,6 +553,17 @@ class WinMain(tk.Tk):
             self.var_arch.get()
         ))
 
+    def cmd_btn_cancel(self):
+        """ Handles btn_cancel click. Cancels a running conversion, after
+            the current master file is finished.
+        """
+        if self.conversion_cancel is None:
+            return
+        debug('Cancelling conversion...')
+        self.conversion_cancel.set()
+        self.btn_cancel.configure(state=tk.DISABLED)
+        self.var_progress.set('Cancelling...')
+
     def cmd_btn_dat(self):
         """ Handles btn_dat click. """
         dat_dir = filedialog.askdirectory()
@@ -515,7 +580,10 @@ class WinMain(tk.Tk):
         self.destroy()
 
     def cmd_btn_run(self):
-        """ Handles btn_run click. """
+        """ Handles btn_run click.
+            The conversion is done in a background thread by
+            `run_conversion()`, and `poll_conversion()` shows the progress.
+        """
         # Validate dirs, but allow an empty archive dir.
         if not self.validate_dirs(ignore_dirs=('archive', )):
             if self.settings.get('auto_run', False):
@@ -524,97 +592,26 @@ class WinMain(tk.Tk):
             return
 
         self.enable_interface(False)
-        mozdir = self.var_dat.get()
-        try:
-            mozfiles = load_moz_files(
-                filepaths=mozdir,
-                ignore_dirs=self.settings['ignore_dirs'],
-                ignore_strs=self.settings['ignore_strs'],
-                split_parts=not self.var_no_part_split.get(),
-            )
-        except OSError as ex:
-            self.show_error(
-                'Cannot load .dat files in: {}\n{}'.format(
-                    mozdir,
-                    ex,
-                ),
-                fatal=self.settings.get('auto_run', False),
-            )
-            self.enable_interface(True)
-            return
-
-        if not mozfiles:
-            self.show_error(
-                'No Mozaik (.dat) files found in: {}'.format(
-                    mozdir,
-                ),
-                fatal=self.settings.get('auto_run', False),
-            )
-            self.enable_interface(True)
-            return
-
-        error_files = []
-
-        def add_error_file(mozfile, msg):
-            error_files.append((mozfile, msg))
-            return 1
-
-        success_files = []
-
-        def add_success_file(mozfile, tigerpath):
-            success_files.append((mozfile, tigerpath))
-            return 0
-
-        time_start = time()
-        errs = 0
-        for mozfile in mozfiles:
-            try:
-                errs += write_tiger_file(
-                    mozfile,
-                    self.entry_tiger.get(),
-                    archive_dir=self.entry_arch.get() or '',
-                    extra_data=self.var_extra_data.get(),
-                    error_cb=add_error_file,
-                    success_cb=add_success_file,
-                )
-            except Exception as ex:
-                print_err('Error writing tiger file: {}\n{}'.format(
-                    mozfile.filepath,
-                    ex
-                ))
-                add_error_file(mozfile, ex)
-                errs += 1
-
-        parentfiles = set(m.parent_file for m in mozfiles)
-
-        config_increment(
-            master_files=len(parentfiles),
-            tiger_files=len(success_files),
-            runs=1,
-            runtime_secs=time() - time_start,
-            default=0,
-        )
-
-        self.show_report(
-            parent_files=parentfiles,
-            error_files=[
-                (mozfile.filepath, msg)
-                for mozfile, msg in sorted(
-                    error_files,
-                    key=lambda tup: tup[0].filepath
-                )
-            ],
-            success_files=[
-                tigerpath
-                for mozfile, tigerpath in sorted(
-                    success_files,
-                    key=lambda tup: tup[1]
-                )
-            ],
-            allow_auto_exit=True,
-            parent_name='Master',
-            success_name='Tiger',
+        self.conversion_queue = Queue()
+        self.conversion_cancel = threading.Event()
+        self.conversion_thread = threading.Thread(
+            target=self.run_conversion,
+            kwargs={
+                'mozdir': self.var_dat.get(),
+                'outdir': self.entry_tiger.get(),
+                'archive_dir': self.entry_arch.get() or '',
+                'extra_data': self.var_extra_data.get(),
+                'split_parts': not self.var_no_part_split.get(),
+                'ignore_dirs': self.settings['ignore_dirs'],
+                'ignore_strs': self.settings['ignore_strs'],
+                'queue': self.conversion_queue,
+                'cancel': self.conversion_cancel,
+            },
+            daemon=True,
         )
+        self.show_progress(True)
+        self.conversion_thread.start()
+        self.after(self.progress_poll_ms, self.poll_conversion)
 
     def cmd_btn_tiger(self):
         """ Handles btn_tiger click. """
@@ -773,8 +770,37 @@ class WinMain(tk.Tk):
             title='Remove {} {}?'.format(filelen, plural)
         )
 
+    def conversion_done(
+            self, parent_files, error_files, success_files, runtime_secs,
+            cancelled=False):
+        """ Called by `poll_conversion()` when `run_conversion()` is done.
+            Saves stats, and shows the report.
+        """
+        self.conversion_thread = None
+        self.conversion_cancel = None
+        config_increment(
+            master_files=len(parent_files),
+            tiger_files=len(success_files),
+            runs=1,
+            runtime_secs=runtime_secs,
+            default=0,
+        )
+
+        self.show_report(
+            parent_files=parent_files,
+            error_files=sorted(error_files, key=lambda tup: tup[0]),
+            success_files=sorted(success_files),
+            allow_auto_exit=True,
+            parent_name='Master',
+            success_name='Tiger',
+            cancelled=cancelled,
+        )
+
     def destroy(self, save_config=True):
-        if save_config:
+        if self.conversion_cancel is not None:
+            # Stop the conversion thread after the current master file.
+            self.conversion_cancel.set()
+        if save_config and self.save_config:
             debug('Saving gui config...')
             self.settings['dat_dir'] = [self.entry_dat.get()]
             self.settings['tiger_dir'] = self.entry_tiger.get()
@@ -842,12 +868,156 @@ class WinMain(tk.Tk):
             return None
         return sorted(names)[0]
 
+    def poll_conversion(self):
+        """ Handle messages from `run_conversion()`, and update the progress
+            bar. This reschedules itself until the conversion is done.
+        """
+        try:
+            while True:
+                msgtype, value = self.conversion_queue.get_nowait()
+                if msgtype == 'total':
+                    self.prg_run.configure(maximum=value, value=0)
+                elif msgtype == 'file':
+                    index, filepath = value
+                    self.prg_run.configure(value=index)
+                    if not self.conversion_cancel.is_set():
+                        self.var_progress.set(trim_file_path(filepath))
+                elif msgtype == 'error':
+                    self.show_progress(False)
+                    self.conversion_thread = None
+                    self.conversion_cancel = None
+                    self.show_error(
+                        value,
+                        fatal=self.settings.get('auto_run', False),
+                    )
+                    self.enable_interface(True)
+                    return
+                elif msgtype == 'done':
+                    self.show_progress(False)
+                    self.conversion_done(**value)
+                    return
+        except Empty:
+            pass
+        self.after(self.progress_poll_ms, self.poll_conversion)
+
     def report_closed(self, allow_auto_exit=False):
         """ Called when the report window is closed. """
         self.enable_interface()
         if allow_auto_exit and self.var_auto_exit.get():
             self.destroy()
 
+    def run_conversion(
+            self, mozdir, outdir, archive_dir, extra_data, split_parts,
+            ignore_dirs, ignore_strs, queue, cancel):
+        """ Convert all master files in `mozdir`, putting progress messages
+            in `queue` for `poll_conversion()`.
+            This runs in a background thread, so it must not touch any
+            widgets. It stops early if the `cancel` Event is set.
+        """
+        run_metrics.reset()
+        try:
+            filepaths = get_moz_file_paths(
+                mozdir,
+                ignore_dirs=ignore_dirs,
+                ignore_strs=ignore_strs,
+            )
+        except (OSError, ValueError) as ex:
+            queue.put((
+                'error',
+                'Cannot load .dat files in: {}\n{}'.format(mozdir, ex),
+            ))
+            return
+        if not filepaths:
+            queue.put((
+                'error',
+                'No Mozaik (.dat) files found in: {}'.format(mozdir),
+            ))
+            return
+        queue.put(('total', len(filepaths)))
+
+        parent_files = set()
+        error_files = []
+
+        def add_error_file(mozfile, msg):
+            error_files.append((mozfile.filepath, msg))
+            return 1
+
+        success_files = []
+
+        def add_success_file(mozfile, tigerpath):
+            success_files.append(tigerpath)
+            return 0
+
+        # Unchanged master files are not converted again.
+        cache = ConversionCache(
+            extra_data=extra_data,
+            split_parts=split_parts,
+        )
+        # Existing tiger file names, listed once, for naming new files.
+        name_index = FileNameIndex(outdir)
+        time_start = time()
+        cancelled = False
+        for i, filepath in enumerate(filepaths):
+            if cancel.is_set():
+                debug('Conversion cancelled before: {}'.format(filepath))
+                cancelled = True
+                break
+            queue.put(('file', (i, filepath)))
+            tigerpaths = cache.reuse(
+                filepath,
+                outdir,
+                archive_dir=archive_dir,
+            )
+            if tigerpaths is not None:
+                parent_files.add(filepath)
+                success_files.extend(tigerpaths)
+                continue
+            try:
+                mozfiles = load_moz_file(filepath, split_parts=split_parts)
+            except Exception as ex:
+                print_err('Error loading master file: {}\n{}'.format(
+                    filepath,
+                    ex
+                ))
+                error_files.append((filepath, ex))
+                continue
+            errors_before = len(error_files)
+            success_before = len(success_files)
+            for mozfile in mozfiles:
+                parent_files.add(mozfile.parent_file)
+                try:
+                    write_tiger_file(
+                        mozfile,
+                        outdir,
+                        archive_dir=archive_dir,
+                        extra_data=extra_data,
+                        error_cb=add_error_file,
+                        success_cb=add_success_file,
+                        name_index=name_index,
+                    )
+                except Exception as ex:
+                    print_err('Error writing tiger file: {}\n{}'.format(
+                        mozfile.filepath,
+                        ex
+                    ))
+                    add_error_file(mozfile, ex)
+            tigerpaths = success_files[success_before:]
+            if tigerpaths and (len(error_files) == errors_before):
+                cache.add(filepath, tigerpaths)
+        cache.save()
+        run_metrics.save()
+        queue.put(('file', (len(filepaths), '')))
+        queue.put((
+            'done',
+            {
+                'parent_files': parent_files,
+                'error_files': error_files,
+                'success_files': success_files,
+                'runtime_secs': time() - time_start,
+                'cancelled': cancelled,
+            },
+        ))
+
     def show_error(self, msg, fatal=False):
         """ Use show_error, but make sure this window is out of the way.
             If `fatal` is truthy, call `self.destroy()` afterwards.
@@ -872,6 +1042,21 @@ class WinMain(tk.Tk):
         else:
             self.lift()
 
+    def show_progress(self, enabled=True):
+        """ Show/hide the progress bar and Cancel button. """
+        if enabled:
+            self.var_progress.set('')
+            self.prg_run.configure(value=0)
+            self.btn_cancel.configure(state=tk.NORMAL)
+            self.frm_progress.pack(
+                side=tk.LEFT,
+                fill=tk.X,
+                expand=True,
+                padx=2,
+            )
+        else:
+            self.frm_progress.pack_forget()
+
     def show_question(self, msg, title=None):
         """ Show a tkinter askyesno dialog, but make sure this window is
             out of the way.
@@ -886,7 +1071,8 @@ class WinMain(tk.Tk):
 
     def show_report(
             self, parent_files, error_files, success_files,
-            allow_auto_exit=True, parent_name='Master', success_name='Tiger'):
+            allow_auto_exit=True, parent_name='Master', success_name='Tiger',
+            cancelled=False):
         """ Show a report for moz->tiger transformations or unarchiving files
         """
         # self.report_closed() will re-enable the interface.
@@ -894,6 +1080,8 @@ class WinMain(tk.Tk):
         reportmsg = 'Success'
         if error_files:
             reportmsg = 'Errors: {}'.format(len(error_files))
+        if cancelled:
+            reportmsg = 'Cancelled, {}'.format(reportmsg)
 
         self.win_report = WinReport(  # noqa
             self,
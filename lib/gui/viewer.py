@@ -34,6 +34,28 @@ from ..util.preview import (
     check_file,
 )
 
+# Number of rows to insert into a Treeview at a time. The rest are inserted
+# later (with `after()`), so the window stays responsive while loading.
+ROW_CHUNK_SIZE = 250
+# Files with more parts than this are shown through a window of Treeview
+# items, re-filled from the backing list of rows while scrolling.
+VIRTUAL_ROW_LIMIT = 5000
+
+# Pattern to split numbers from text, for natural_key().
+natural_key_pat = re.compile(r'(\d+)')
+
+
+def natural_key(s):
+    """ Sort key for room/cab numbers (or any text) with numbers in them,
+        where the numbers are compared as ints: R1:2 < R1:2(2) < R1:10
+    """
+    if s is None:
+        return ()
+    return tuple(
+        int(piece) if piece.isdigit() else piece.lower()
+        for piece in natural_key_pat.split(str(s))
+    )
+
 
 class WinViewer(WinToplevelBase):
     def __init__(
@@ -275,13 +297,31 @@ class WinViewer(WinToplevelBase):
             selectmode='browse',
             height=15,
         )
-        tree_view.pack(side=tk.LEFT, fill=tk.X, expand=True)
+        tree_view.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
         tree_view.configure(
             columns=self.columns,
             show='headings',
         )
         # Save info about how columns are sorted.
         tree_view.sorted = {}
+        # Backing list of (rowid, values, tag) for all rows, set in
+        # `self.view_tigerfile()`. Values are formatted strings.
+        tree_view.rows = []
+        # Raw (typed) part values for each rowid.
+        tree_view.raw_values = []
+        # Sort keys for each rowid, by column name. Built on first sort.
+        tree_view.sort_keys = {}
+        # The `after()` id while rows are still being inserted.
+        tree_view.load_job = None
+        # Whether the rows are shown through a window of re-used items,
+        # and the first row in that window.
+        tree_view.virtual = False
+        tree_view.window_ids = []
+        tree_view.offset = 0
+        # The rowid that is selected, because window items are re-used for
+        # other rows while scrolling.
+        tree_view.selected_rowid = None
+        tree_view.filepath = filepath
         # Build columns/headings.
         for colname in self.columns:
             tree_view.column(colname, **self.column_info[colname])
@@ -297,11 +337,18 @@ class WinViewer(WinToplevelBase):
         scroll_view = ttk.Scrollbar(
             frm_tree,
             orient='vertical',
-            command=tree_view.yview,
+            command=lambda *args: self.scroll_treeview(tree_view, *args),
         )
         tree_view.configure(
             yscrollcommand=scroll_view.set
         )
+        tree_view.scroll_view = scroll_view
+        for eventname in ('<MouseWheel>', '<Button-4>', '<Button-5>'):
+            tree_view.bind(eventname, self.event_treeview_wheel)
+        for eventname in ('<Up>', '<Down>', '<Prior>', '<Next>'):
+            tree_view.bind(eventname, self.event_treeview_key)
+        tree_view.bind('<Configure>', self.event_treeview_configure)
+        tree_view.bind('<<TreeviewSelect>>', self.event_treeview_select)
         scroll_view.pack(
             side=tk.RIGHT,
             fill=tk.Y,
@@ -335,11 +382,12 @@ class WinViewer(WinToplevelBase):
         lbl_view.pack(
             side=tk.BOTTOM,
             fill=tk.X,
-            expand=True,
+            expand=False,
             padx=2,
             pady=2,
         )
 
+        tree_view.lbl_view = lbl_view
         # Save references to these, for modifying/removing.
         self.lbl_views.append(lbl_view)
         self.tree_views.append(tree_view)
@@ -361,8 +409,18 @@ class WinViewer(WinToplevelBase):
         for tabid in tabids:
             self.remove_tab(tabid)
 
+    def cancel_load(self, tree_view):
+        """ Stop inserting rows into a Treeview, if it's still loading. """
+        if tree_view.load_job is not None:
+            self.after_cancel(tree_view.load_job)
+            tree_view.load_job = None
+
     def clear_treeview(self, index):
-        self.tree_views[index].delete(*self.tree_views[index].get_children())
+        tree_view = self.tree_views[index]
+        self.cancel_load(tree_view)
+        tree_view.delete(*tree_view.get_children())
+        tree_view.window_ids = []
+        tree_view.selected_rowid = None
 
     def cmd_btn_close(self):
         """ Close the currently selected tab. """
@@ -418,6 +476,8 @@ class WinViewer(WinToplevelBase):
         return lambda: self.sort_treeview(treeview, colname)
 
     def destroy(self):
+        for tree_view in self.tree_views:
+            self.cancel_load(tree_view)
         debug('Saving gui-viewer config...')
         self.settings['geometry_viewer'] = self.geometry()
         config_save(self.settings)
@@ -465,6 +525,104 @@ class WinViewer(WinToplevelBase):
         for name in menus:
             self.menu_main.entryconfigure(name, state=state)
 
+    def event_treeview_configure(self, event):
+        """ Resize the window of items for a Treeview that is showing a
+            window of rows, when it's shown or resized.
+        """
+        tree_view = event.widget
+        if tree_view.virtual:
+            self.resize_window(tree_view)
+
+    def event_treeview_key(self, event):
+        """ Handle Up/Down/PageUp/PageDown for a Treeview that is showing
+            a window of rows, scrolling when the selection is at the edge.
+        """
+        tree_view = event.widget
+        if not tree_view.virtual:
+            return None
+        if event.keysym in ('Prior', 'Next'):
+            direction = -1 if event.keysym == 'Prior' else 1
+            self.scroll_treeview(tree_view, 'scroll', direction, 'pages')
+            return 'break'
+        selected = tree_view.selection()
+        if not selected:
+            return None
+        if (event.keysym == 'Up') and (selected[0] == tree_view.window_ids[0]):
+            self.select_row(tree_view, tree_view.offset - 1)
+            self.scroll_treeview(tree_view, 'scroll', -1, 'units')
+            return 'break'
+        if (event.keysym == 'Down') and (
+                selected[0] == tree_view.window_ids[-1]):
+            self.select_row(
+                tree_view,
+                tree_view.offset + len(tree_view.window_ids),
+            )
+            self.scroll_treeview(tree_view, 'scroll', 1, 'units')
+            return 'break'
+        return None
+
+    def event_treeview_select(self, event):
+        """ Remember which row is selected in a Treeview that is showing a
+            window of rows.
+        """
+        tree_view = event.widget
+        if not tree_view.virtual:
+            return None
+        selected = tree_view.selection()
+        if not selected:
+            # Cleared by `fill_window()`, the row was scrolled out of view.
+            return None
+        try:
+            index = tree_view.window_ids.index(selected[0])
+        except ValueError:
+            return None
+        self.select_row(tree_view, tree_view.offset + index)
+        return None
+
+    def event_treeview_wheel(self, event):
+        """ Handle the mouse wheel for a Treeview that is showing a window
+            of rows.
+        """
+        tree_view = event.widget
+        if not tree_view.virtual:
+            return None
+        if event.num == 4:
+            amount = -3
+        elif event.num == 5:
+            amount = 3
+        else:
+            # Windows/Mac deltas are multiples of 120, or small steps.
+            amount = -3 if event.delta > 0 else 3
+        self.scroll_treeview(tree_view, 'scroll', amount, 'units')
+        return 'break'
+
+    def fill_window(self, tree_view):
+        """ Fill the window of Treeview items with rows from the backing
+            list, starting at `tree_view.offset`.
+        """
+        rows = tree_view.rows
+        height = len(tree_view.window_ids)
+        tree_view.offset = max(0, min(tree_view.offset, len(rows) - height))
+        for itemid, (_, values, tag) in zip(
+                tree_view.window_ids,
+                rows[tree_view.offset:tree_view.offset + height]):
+            tree_view.item(itemid, values=values, tags=(tag, ))
+        # Keep the selection on the same row, not the same item.
+        selected = [
+            itemid
+            for itemid, (rowid, _, _) in zip(
+                tree_view.window_ids,
+                rows[tree_view.offset:tree_view.offset + height])
+            if rowid == tree_view.selected_rowid
+        ]
+        tree_view.selection_set(selected)
+        if selected:
+            tree_view.focus(selected[0])
+        tree_view.scroll_view.set(
+            tree_view.offset / len(rows),
+            (tree_view.offset + height) / len(rows),
+        )
+
     def format_value(self, column, value):
         """ Format a value for the tree_view, with decent default values. """
         defaults = {
@@ -510,6 +668,56 @@ class WinViewer(WinToplevelBase):
             for tigerfile in TigerFiles.from_file(filepath, split_parts=True):
                 self.view_tigerfile(tigerfile)
 
+    def insert_rows(self, tree_view, start=0):
+        """ Insert a chunk of rows into a Treeview, starting at the `start`
+            index in `tree_view.rows`, and schedule the next chunk.
+        """
+        tree_view.load_job = None
+        end = min(start + ROW_CHUNK_SIZE, len(tree_view.rows))
+        for rowid, values, tag in tree_view.rows[start:end]:
+            tree_view.insert(
+                '',
+                tk.END,
+                iid=str(rowid),
+                values=values,
+                text='',
+                tag=tag,
+            )
+        self.set_row_count(tree_view, end)
+        if end < len(tree_view.rows):
+            tree_view.load_job = self.after(
+                1,
+                self.insert_rows,
+                tree_view,
+                end,
+            )
+
+    def load_rows(self, tree_view):
+        """ Show `tree_view.rows` in a Treeview, replacing any items that
+            are already there.
+            Small files are inserted in chunks, large files are shown through
+            a window of items.
+        """
+        self.cancel_load(tree_view)
+        tree_view.delete(*tree_view.get_children())
+        tree_view.window_ids = []
+        tree_view.virtual = len(tree_view.rows) > VIRTUAL_ROW_LIMIT
+        if not tree_view.virtual:
+            tree_view.configure(yscrollcommand=tree_view.scroll_view.set)
+            self.insert_rows(tree_view)
+            return
+        # The Treeview doesn't scroll, the window is re-filled instead.
+        tree_view.configure(yscrollcommand='')
+        tree_view.window_ids = [
+            tree_view.insert('', tk.END, values=(), text='')
+            for _ in range(int(tree_view.cget('height')))
+        ]
+        tree_view.offset = 0
+        self.fill_window(tree_view)
+        # Use the visible height, if the Treeview is already shown.
+        self.resize_window(tree_view)
+        self.set_row_count(tree_view, len(tree_view.rows))
+
     def remove_tab(self, tabid):
         """ Remove a tab and it's associated file name. """
         tabid = self.tab_index(tabid)
@@ -517,6 +725,7 @@ class WinViewer(WinToplevelBase):
             # Can't remove the default tab.
             debug('Not removing the default tab.')
             return
+        self.cancel_load(self.tree_views[tabid])
         # Normal index
         self.notebook.forget(tabid)
         self.filepaths.pop(tabid)
@@ -527,6 +736,59 @@ class WinViewer(WinToplevelBase):
             self.build_tab()
             self.enable_close(False)
 
+    def resize_window(self, tree_view):
+        """ Add or remove window items for a Treeview that is showing a
+            window of rows, so they fill the visible area, and re-fill it.
+        """
+        height = self.window_height(tree_view)
+        window_ids = tree_view.window_ids
+        if height > len(window_ids):
+            window_ids.extend(
+                tree_view.insert('', tk.END, values=(), text='')
+                for _ in range(height - len(window_ids))
+            )
+        elif height < len(window_ids):
+            tree_view.delete(*window_ids[height:])
+            del window_ids[height:]
+        else:
+            return
+        self.fill_window(tree_view)
+
+    def scroll_treeview(self, tree_view, *args):
+        """ Handle scrollbar commands for a Treeview, like:
+                ('moveto', fraction) or ('scroll', amount, 'units'/'pages')
+            Normal Treeviews are scrolled with `yview()`, windowed Treeviews
+            are re-filled.
+        """
+        if not tree_view.virtual:
+            return tree_view.yview(*args)
+        if args[0] == 'moveto':
+            tree_view.offset = int(float(args[1]) * len(tree_view.rows))
+        else:
+            amount = int(args[1])
+            if args[2] == 'pages':
+                amount *= len(tree_view.window_ids)
+            tree_view.offset += amount
+        self.fill_window(tree_view)
+
+    def select_row(self, tree_view, index):
+        """ Remember the row at `index` in `tree_view.rows` as the selected
+            row, if there is one.
+        """
+        if 0 <= index < len(tree_view.rows):
+            tree_view.selected_rowid = tree_view.rows[index][0]
+
+    def set_row_count(self, tree_view, loaded):
+        """ Show how many rows are loaded in a Treeview's label. """
+        total = len(tree_view.rows)
+        if loaded < total:
+            countstr = 'loading {} of {} parts...'.format(loaded, total)
+        else:
+            countstr = '{} {}'.format(total, 'part' if total == 1 else 'parts')
+        tree_view.lbl_view.configure(
+            text='{} ({})'.format(tree_view.filepath, countstr),
+        )
+
     def show_question(self, msg, title=None):
         """ Use show_question, but make sure this window is out of the way.
         """
@@ -537,6 +799,30 @@ class WinViewer(WinToplevelBase):
         self.deiconify()
         return ret
 
+    def sort_keys(self, treeview, column_name):
+        """ Returns a list of sort keys for a column (by rowid), building
+            it from the raw part values the first time.
+        """
+        sort_keys = treeview.sort_keys.get(column_name, None)
+        if sort_keys is not None:
+            return sort_keys
+        column_index = self.columns.index(column_name)
+        if column_name in ('index', 'quantity', 'completed', 'length'):
+            # Already int/float, from the TigerFile.
+            def sortable(value):
+                return value or 0
+        elif column_name == 'no':
+            # "Smart" sorting for rooms/cabs.
+            sortable = natural_key
+        else:
+            def sortable(value):
+                return '' if value is None else str(value)
+        sort_keys = treeview.sort_keys[column_name] = [
+            sortable(values[column_index])
+            for values in treeview.raw_values
+        ]
+        return sort_keys
+
     def sort_treeview(self, treeview, column_name):
         """ Sort a Treeview's items based on a `column_name` from
             `self.columns`.
@@ -544,39 +830,23 @@ class WinViewer(WinToplevelBase):
             `treeview.sorted[column_name]`. It was set in `build_tab()`
             already.
         """
-        column_index = self.columns.index(column_name)
-
-        if column_name == 'length':
-            sortable = float
-        elif column_name in ('index', 'quantity', 'completed'):
-            sortable = int
-        elif column_name == 'no':
-            # "Smart" sorting for rooms/cabs.
-            def no_sort(no):
-                try:
-                    room, cab = no.split(':')
-                except ValueError:
-                    room = '1'
-                    cab = no
-                room = room.lstrip('Rr')
-                cab = re.sub(r'&|\(\d+\)', '', cab)
-                return int(room), int(cab)
-            sortable = no_sort
-        else:
-            sortable = str
-
-        def sort_key(itemid):
-            iteminfo = treeview.item(itemid)
-            return sortable(iteminfo['values'][column_index])
-
-        sortedinfo = list(sorted(
-            (itemid for itemid in treeview.get_children()),
-            key=sort_key,
+        sort_keys = self.sort_keys(treeview, column_name)
+        # Sort the backing rows, and show them again.
+        treeview.rows.sort(
+            key=lambda row: sort_keys[row[0]],
             reverse=treeview.sorted[column_name],
-        ))
-
-        for i, itemid in enumerate(sortedinfo):
-            treeview.move(itemid, '', i)
+        )
+        if treeview.virtual:
+            self.fill_window(treeview)
+        elif treeview.load_job is None:
+            # All rows are inserted, reorder them with one call.
+            treeview.set_children(
+                '',
+                *(str(rowid) for rowid, _, _ in treeview.rows)
+            )
+        else:
+            # Still loading, start over with the sorted rows.
+            self.load_rows(treeview)
         # Tag s with the direction they need to be sorted next time.
         for colname in self.columns:
             if colname == column_name:
@@ -617,28 +887,50 @@ class WinViewer(WinToplevelBase):
             self.notebook.tab(0, text=fname)
 
         self.filepaths.append(tigerfile.filepath)
+        tree_view.filepath = tigerfile.filepath
 
+        rows = []
+        raw_values = []
         for i, part in enumerate(tigerfile.parts):
             # Get raw part values.
             values = [
                 getattr(part, colname, None)
                 for colname in self.columns
             ]
+            raw_values.append(values)
             quantity = values[1]
             completed = values[2]
             remaining = quantity - completed
             tag = 'odd' if i % 2 else 'even'
             tag = '{}{}'.format(tag, '' if remaining else '_completed')
-            # Insert formatted values:
-            tree_view.insert(
-                '',
-                tk.END,
-                values=tuple(
+            # Formatted values:
+            rows.append((
+                i,
+                tuple(
                     self.format_value(self.columns[i], v)
                     for i, v in enumerate(values)
                 ),
-                text='',
-                tag=tag,
-            )
+                tag,
+            ))
+        tree_view.rows = rows
+        tree_view.raw_values = raw_values
+        tree_view.sort_keys = {}
+        tree_view.selected_rowid = None
+        self.load_rows(tree_view)
         self.notebook.select(self.notebook.tabs()[-1])
         self.enable_close(True)
+
+    def window_height(self, tree_view):
+        """ Returns the number of rows that fit in the visible area of a
+            Treeview, or it's configured height if it isn't shown yet.
+        """
+        height = int(tree_view.cget('height'))
+        if not tree_view.window_ids:
+            return height
+        bbox = tree_view.bbox(tree_view.window_ids[0])
+        if not bbox:
+            return height
+        _, top, _, rowheight = bbox
+        if rowheight < 1:
+            return height
+        return max(1, (tree_view.winfo_height() - top) // rowheight)
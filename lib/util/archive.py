@@ -24,6 +24,7 @@ from .logger import (
     print_err,
     status,
 )
+from .metrics import run_metrics
 
 colr_auto_disable()
 
@@ -33,46 +34,57 @@ archive_split_char = '__'
 # Map from parent file name to FinishedFile object. Used by archive_file().
 _finished_files = {}
 
+# Pattern to find the (num) in file names from increment_file_path().
+increment_num_pat = re.compile(r'.+(\(\d+\))\.\w{1,5}$')
+# Flags for creating new files with `open_new_file()`, without replacing
+# existing files (even if another process just created them).
+NEW_FILE_FLAGS = (
+    os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0)
+)
+
 
 def archive_file(filepath, archive_dir, created_files=None):
     """ Archive a parent file. If it was already archived, it's created files
         are still added to it's `created_files` list.
     """
-    existing = _finished_files.get(filepath, None)
-    if existing is not None:
-        existing.add_created(created_files)
-        if existing.is_archived:
-            debug('Already archived: {}'.format(filepath))
-            return True
-        debug('Already tried to archive: {}'.format(filepath))
-        return False
-    archfile = FinishedFile(filepath, archive_dir, created_files=created_files)
-    _finished_files[filepath] = archfile
-    return archfile.archive()
+    with run_metrics.timer('archive'):
+        existing = _finished_files.get(filepath, None)
+        if existing is not None:
+            existing.add_created(created_files)
+            if existing.is_archived:
+                debug('Already archived: {}'.format(filepath))
+                return True
+            debug('Already tried to archive: {}'.format(filepath))
+            return False
+        archfile = FinishedFile(
+            filepath,
+            archive_dir,
+            created_files=created_files,
+        )
+        _finished_files[filepath] = archfile
+        return archfile.archive()
 
 
-def increment_file_path(path):
-    """ Turns file paths like: /dir/filepath.ext into /dir/filepath(2).ext
+def forget_finished_file(filepath):
+    """ Forget that a master file was archived (or tried to be), so a new
+        file at the same path is archived again by `archive_file()`.
+        This is needed when Tiger Tamer keeps running (--watch), and the
+        same master file is exported more than once.
+        Returns the forgotten FinishedFile, or None.
     """
-    numpat = re.compile(r'.+(\(\d+\))\.\w{1,5}$')
-    match = numpat.search(path)
+    return _finished_files.pop(filepath, None)
 
-    fpath, ext = os.path.splitext(path)
-    if (match is None) or (not match):
-        # First file.
-        newpath = ''.join((fpath, '(1)', ext))
-        if os.path.exists(newpath):
-            return increment_file_path(newpath)
-        return newpath
 
-    # Get the (num) part and strip the parens.
-    numpart = match.groups()[0]
-    num = int(numpart[1:-1])
-    # Rebuild the number, and replace the old one.
-    newnum = '({})'.format(num + 1)
-    newpath = path.replace(numpart, newnum)
-    if os.path.exists(newpath):
-        return increment_file_path(newpath)
+def increment_file_path(path, exists=os.path.exists):
+    """ Turns file paths like: /dir/filepath.ext into /dir/filepath(1).ext,
+        or /dir/filepath(1).ext into /dir/filepath(2).ext, until
+        `exists(newpath)` is False.
+        A FileNameIndex's `exists` method can be used to do this without
+        checking the file system for every name.
+    """
+    newpath = next_file_path(path)
+    while exists(newpath):
+        newpath = next_file_path(newpath)
     return newpath
 
 
@@ -84,6 +96,60 @@ def list_archive(arch_dir, dest_dir):
     return 0 if archive else 1
 
 
+def next_file_path(path):
+    """ Turns file paths like: /dir/filepath.ext into /dir/filepath(1).ext,
+        or /dir/filepath(1).ext into /dir/filepath(2).ext.
+    """
+    dirpath, fname = os.path.split(path)
+    match = increment_num_pat.search(fname)
+    if match is None:
+        # First file.
+        fname, ext = os.path.splitext(fname)
+        return os.path.join(dirpath, ''.join((fname, '(1)', ext)))
+
+    # Get the (num) part and strip the parens.
+    numpart = match.groups()[0]
+    num = int(numpart[1:-1])
+    # Rebuild the number, and replace the old one.
+    start, end = match.span(1)
+    return os.path.join(
+        dirpath,
+        '{}({}){}'.format(fname[:start], num + 1, fname[end:]),
+    )
+
+
+def open_new_file(path, mode='w', name_index=None):
+    """ Create and open a new file, without replacing an existing one.
+        If `path` exists, a (num) is added to the name
+        (see `increment_file_path()`).
+        With a FileNameIndex, names that are known to exist are skipped
+        without checking the file system, and the new name is added to it.
+        Files are created with O_EXCL, so a file that was created since
+        the index was built is never replaced.
+        Returns (path, file_object).
+    """
+    while True:
+        if (name_index is not None) and name_index.exists(path):
+            path = next_file_path(path)
+            continue
+        try:
+            fd = os.open(path, NEW_FILE_FLAGS, 0o666)
+        except FileExistsError:
+            debug('File was already created: {}'.format(path))
+            if name_index is not None:
+                name_index.add(path)
+            path = next_file_path(path)
+            continue
+        break
+    if name_index is not None:
+        name_index.add(path)
+    try:
+        return path, open(fd, mode)
+    except BaseException:
+        os.close(fd)
+        raise
+
+
 def remove_dir_if_empty(path):
     """ Remove a directory, if it's empty.
         Returns True if everything went well.
@@ -289,7 +355,8 @@ class ArchiveFile(object):
         """ Returns a list of output files created by this archive file. """
         try:
             with open(self.info_path, 'r') as f:
-                created = list(sorted(s.strip() for s in f))
+                # Lines are appended, so there may be duplicates.
+                created = sorted(set(s.strip() for s in f if s.strip()))
         except FileNotFoundError:
             debug('No created files info for: {}'.format(self.filepath))
             return []
@@ -389,6 +456,58 @@ class ArchiveFile(object):
         return success and self.remove_info_file()
 
 
+class FileNameIndex(object):
+    """ The file names in a directory, listed once and updated as files are
+        created, so new file names can be chosen without checking the file
+        system for each one.
+        Names are compared with `os.path.normcase()`, like the file system
+        does on Windows.
+    """
+    def __init__(self, dirpath):
+        self.dirpath = dirpath
+        # Loaded on first use.
+        self.names = None
+
+    def __contains__(self, path):
+        return self.exists(path)
+
+    def __repr__(self):
+        return '{}(dirpath={!r})'.format(type(self).__name__, self.dirpath)
+
+    def add(self, path):
+        """ Remember that a file exists in this directory. """
+        self.load().add(os.path.normcase(os.path.basename(path)))
+
+    def discard(self, path):
+        """ Forget a file that was removed from this directory. """
+        self.load().discard(os.path.normcase(os.path.basename(path)))
+
+    def exists(self, path):
+        """ Returns True if a file name (or path in this directory) is
+            known to exist.
+        """
+        return os.path.normcase(os.path.basename(path)) in self.load()
+
+    def load(self):
+        """ List the directory, if it hasn't been listed yet. """
+        if self.names is not None:
+            return self.names
+        try:
+            names = os.listdir(self.dirpath)
+        except FileNotFoundError:
+            names = []
+        except OSError as ex:
+            # Names will be checked when the files are created.
+            debug_err('Unable to list directory: {}\n{}'.format(
+                self.dirpath,
+                ex,
+            ))
+            names = []
+        self.names = {os.path.normcase(s) for s in names}
+        debug('Indexed {} names in: {}'.format(len(self.names), self.dirpath))
+        return self.names
+
+
 class FinishedFile(object):
     """ A file to archive, because it has been processed. """
     def __init__(self, filepath, archive_dir, created_files=None):
@@ -397,6 +516,8 @@ class FinishedFile(object):
 
         # A list of files that this master file created.
         self.created_files = created_files or []
+        # Files already written to self.info_path, loaded on first save.
+        self.saved_files = None
         # The destination archive dir.
         self.archive_dir = archive_dir
 
@@ -404,6 +525,11 @@ class FinishedFile(object):
         self.is_archived = False
         # Destination/Archived file path.
         self.archived_path = self.get_archived_path()
+        if os.path.exists(self.filepath) and (
+                os.path.exists(self.archived_path)):
+            # A new master file with the same name as an archived one.
+            # Don't add to the other file's .info.
+            self.archived_path = increment_file_path(self.archived_path)
         # File path for created files info.
         fpath, ext = os.path.splitext(self.archived_path)
         self.info_path = ''.join((fpath, '.info'))
@@ -417,7 +543,10 @@ class FinishedFile(object):
         if not created_files:
             return None
 
-        self.created_files.extend(created_files)
+        self.created_files.extend(
+            s for s in created_files
+            if s not in self.created_files
+        )
         self.save_created()
 
     def archive(self):
@@ -457,6 +586,7 @@ class FinishedFile(object):
         else:
             status('Archived', destfile)
             config_increment(archive_files=1, default=0)
+            run_metrics.count('archived_files')
             self.is_archived = True
 
         return remove_dir_if_empty(self.parent_dir)
@@ -469,35 +599,76 @@ class FinishedFile(object):
         ))
         return os.path.join(self.archive_dir, newparentname)
 
-    def save_created(self):
-        """ Load self.info_path, read the file list, add any new files,
-            and save it.
-            Returns the number of lines written.
+    def compact_created(self, created):
+        """ Rewrite self.info_path with a sorted list of `created` files.
+            Returns True on success.
+        """
+        try:
+            with open(self.info_path, 'w') as f:
+                f.write(''.join('{}\n'.format(s) for s in sorted(created)))
+        except OSError as ex:
+            debug_err('Unable to compact created files for: {}\n{}'.format(
+                self.info_path,
+                ex,
+            ))
+            return False
+        debug('Compacted created files info: {}'.format(self.info_path))
+        return True
+
+    def load_created(self):
+        """ Load the set of created files from self.info_path.
+            If the file has duplicate/blank lines, or does not end with a
+            newline (so it can't be appended to), it is compacted.
+            Returns None if the file can't be read.
         """
         try:
             with open(self.info_path, 'r') as f:
-                created = set(s.strip() for s in f)
+                data = f.read()
         except FileNotFoundError:
             # Not saved yet.
             debug('Saving created files for: {}'.format(self.info_path))
-            created = set()
+            return set()
         except OSError as ex:
             debug_err('Unable to load created files for: {}\n{}'.format(
                 self.info_path,
                 ex,
             ))
             return None
+        lines = data.splitlines()
+        created = set(s.strip() for s in lines if s.strip())
+        if (len(created) != len(lines)) or not data.endswith('\n'):
+            self.compact_created(created)
+        return created
 
-        created.update(self.created_files)
-        self.created_files = list(sorted(created))
-
+    def save_created(self):
+        """ Append any unsaved files from self.created_files to
+            self.info_path.
+            The .info file is only read the first time, and files that are
+            already saved are skipped, so each call is a single append.
+            Returns the number of lines written.
+        """
+        if self.saved_files is None:
+            saved = self.load_created()
+            if saved is None:
+                return None
+            self.saved_files = saved
+            self.created_files = sorted(saved.union(self.created_files))
+        newfiles = [
+            s
+            for s in self.created_files
+            if s not in self.saved_files
+        ]
+        if not newfiles:
+            return 0
         try:
-            with open(self.info_path, 'w') as f:
-                f.write('\n'.join(sorted(created)))
+            with open(self.info_path, 'a') as f:
+                f.write(''.join('{}\n'.format(s) for s in newfiles))
         except OSError as ex:
             debug_err('Unable to save created files for: {}\n{}'.format(
                 self.info_path,
                 ex,
             ))
+            return 0
+        self.saved_files.update(newfiles)
         debug('Saved created files info: {}'.format(self.info_path))
-        return len(created)
+        return len(newfiles)
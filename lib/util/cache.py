@@ -0,0 +1,327 @@
+#!/usr/bin/env python3
+
+""" tigertamer - lib/util/cache.py
+    Remembers which Tiger (.tiger) files were created from each Mozaik (.dat)
+    file, so unchanged master files don't have to be converted again.
+    Also remembers basic info about Mozaik files, so they don't have to be
+    opened on every scan.
+    -Christopher Welborn 10-16-2026
+"""
+
+import hashlib
+import json
+import os
+import shutil
+from contextlib import suppress
+from time import time
+
+from .archive import archive_file
+from .config import (
+    config_get,
+    PID,
+    SCRIPTDIR,
+    VERSION,
+)
+from .logger import (
+    debug,
+    debug_err,
+    status,
+)
+from .metrics import run_metrics
+
+CACHEFILE = os.path.join(SCRIPTDIR, 'tigertamer_cache.json')
+DATINFOFILE = os.path.join(SCRIPTDIR, 'tigertamer_datinfo.json')
+# Maximum number of master files to remember. The oldest are forgotten first.
+CACHE_MAX_ENTRIES = 2000
+# Maximum number of Mozaik file infos to remember.
+DATINFO_MAX_ENTRIES = 20000
+# Bytes to read at a time when hashing master files.
+HASH_CHUNK_SIZE = 65536
+
+
+class JSONCache(object):
+    """ A dict of entries, saved as JSON, that can be shared by several
+        Tiger Tamer processes. Every entry is a dict with a 'time' key, and
+        the oldest entries are removed when there are more than
+        `max_entries`.
+    """
+    # Default file path, for subclasses.
+    default_filepath = None
+    # Default maximum number of entries, for subclasses.
+    max_entries = CACHE_MAX_ENTRIES
+    # Name used in debug messages.
+    name = 'cache'
+
+    def __init__(self, filepath=None):
+        self.filepath = filepath or self.default_filepath
+        # Loaded on first use.
+        self.entries = None
+        # Keys that were added and need to be saved.
+        self.changed = set()
+
+    def __repr__(self):
+        return '{}(filepath={!r})'.format(type(self).__name__, self.filepath)
+
+    def load(self):
+        """ Load cache entries from disk, if they haven't been loaded yet. """
+        if self.entries is not None:
+            return self.entries
+        self.entries = self.load_entries()
+        debug('Loaded {} {} entries.'.format(len(self.entries), self.name))
+        return self.entries
+
+    def load_entries(self):
+        """ Read cache entries from disk. A missing/bad file is an empty
+            cache.
+        """
+        try:
+            with open(self.filepath, 'r') as f:
+                entries = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (EnvironmentError, ValueError) as ex:
+            debug_err('Unable to load {}: {}\n{}'.format(
+                self.name,
+                self.filepath,
+                ex,
+            ))
+            return {}
+        if not isinstance(entries, dict):
+            debug_err('Bad {}: {}'.format(self.name, self.filepath))
+            return {}
+        return entries
+
+    def save(self):
+        """ Save added entries, merging them with any entries that another
+            Tiger Tamer process saved.
+            Returns True if the cache was saved, or there was nothing to save.
+        """
+        if not self.changed:
+            return True
+        entries = self.load_entries()
+        entries.update({k: self.entries[k] for k in self.changed})
+        if len(entries) > self.max_entries:
+            oldest = sorted(entries, key=lambda k: entries[k].get('time', 0))
+            for key in oldest[:len(entries) - self.max_entries]:
+                entries.pop(key)
+        tmpfile = '{}.{}.tmp'.format(self.filepath, PID)
+        try:
+            with open(tmpfile, 'w') as f:
+                json.dump(entries, f, indent=4, sort_keys=True)
+            os.replace(tmpfile, self.filepath)
+        except EnvironmentError as ex:
+            debug_err('Unable to save {}: {}\n{}'.format(
+                self.name,
+                self.filepath,
+                ex,
+            ))
+            return False
+        finally:
+            with suppress(FileNotFoundError):
+                os.remove(tmpfile)
+        debug('Saved {} {} entries.'.format(len(self.changed), self.name))
+        self.entries = entries
+        self.changed.clear()
+        return True
+
+    def set(self, key, entry):
+        """ Add or replace an entry, to be saved with `save()`. """
+        self.load()
+        entry['time'] = time()
+        self.entries[key] = entry
+        self.changed.add(key)
+        return entry
+
+
+class ConversionCache(JSONCache):
+    """ Maps a hash of a master file's content, and the settings that were
+        used to convert it, to the tiger files that were created from it.
+        Entries are only used when all of their tiger files still exist.
+    """
+    default_filepath = CACHEFILE
+    name = 'conversion cache'
+
+    def __init__(self, filepath=None, extra_data=False, split_parts=True):
+        super().__init__(filepath=filepath)
+        self.extra_data = extra_data
+        self.split_parts = split_parts
+        # Keys for master files that were hashed, {datpath: key}.
+        # The master files may be archived before their entries are added.
+        self.keys = {}
+
+    def __repr__(self):
+        return '{}(filepath={!r}, settings_hash={!r})'.format(
+            type(self).__name__,
+            self.filepath,
+            self.settings_hash,
+        )
+
+    def add(self, datpath, tigerpaths):
+        """ Remember the tiger files that were created from a master file.
+            The master file must have been hashed with `key()` or `reuse()`
+            before it was archived.
+        """
+        key = self.keys.get(datpath, None)
+        if key is None:
+            debug_err('Master file was not hashed, not caching: {}'.format(
+                datpath,
+            ))
+            return False
+        self.set(key, {'files': [os.path.abspath(s) for s in tigerpaths]})
+        return True
+
+    def forget(self, datpath):
+        """ Forget the key for a master file path, so it's hashed again.
+            This is needed when the same path is exported more than once
+            while Tiger Tamer is running (--watch).
+        """
+        return self.keys.pop(datpath, None)
+
+    @staticmethod
+    def hash_settings(extra_data=False, split_parts=True):
+        """ Hash everything (besides the master file content) that changes
+            the tiger files that are created.
+            Label config is part of the `tiger_settings`.
+        """
+        settings = {
+            'extra_data': bool(extra_data),
+            'split_parts': bool(split_parts),
+            'tiger_settings': config_get('tiger_settings', {}),
+            'version': VERSION,
+        }
+        return hashlib.sha1(
+            json.dumps(settings, sort_keys=True).encode()
+        ).hexdigest()
+
+    def key(self, datpath):
+        """ Returns the cache key for a master file, or None if it can't be
+            read.
+            Tiger file names come from the master file's path (job name and
+            file name), so they are part of the key.
+        """
+        key = self.keys.get(datpath, None)
+        if key is not None:
+            return key
+        hasher = hashlib.sha1(self.settings_hash.encode())
+        hasher.update(self.name_key(datpath).encode())
+        try:
+            with open(datpath, 'rb') as f:
+                for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+                    hasher.update(chunk)
+        except EnvironmentError as ex:
+            debug_err('Unable to hash master file: {}\n{}'.format(
+                datpath,
+                ex,
+            ))
+            return None
+        key = self.keys[datpath] = hasher.hexdigest()
+        return key
+
+    @staticmethod
+    def link_file(src, dest):
+        """ Hard-link (or copy) a tiger file into another directory.
+            Returns True if `dest` is the same file as `src` afterwards.
+        """
+        if os.path.exists(dest):
+            return os.path.samefile(src, dest)
+        try:
+            os.link(src, dest)
+        except OSError:
+            try:
+                shutil.copy2(src, dest)
+            except EnvironmentError as ex:
+                debug_err('Unable to copy tiger file: {} -> {}\n{}'.format(
+                    src,
+                    dest,
+                    ex,
+                ))
+                return False
+        debug('Linked cached tiger file: {} -> {}'.format(src, dest))
+        return True
+
+    @staticmethod
+    def name_key(datpath):
+        """ Returns the part of a master file's tiger file names that comes
+            from it's path, like: 'Job Name file[0in].tiger'
+        """
+        # Imported here, because the parser imports this module.
+        from .parser import MozaikFile
+        return MozaikFile(datpath, 0).filepath
+
+    def reuse(self, datpath, outdir, archive_dir=None):
+        """ If `datpath` was already converted with the same settings, make
+            sure it's tiger files are in `outdir`, archive it, and return the
+            tiger file paths.
+            Returns None if the master file must be converted.
+        """
+        key = self.key(datpath)
+        if key is None:
+            return None
+        entry = self.load().get(key, None)
+        if not entry:
+            return None
+        cachedpaths = entry.get('files', [])
+        if not (cachedpaths and all(os.path.exists(s) for s in cachedpaths)):
+            debug('Cached tiger files are missing for: {}'.format(datpath))
+            return None
+        tigerpaths = [
+            os.path.join(outdir, os.path.basename(s))
+            for s in cachedpaths
+        ]
+        for cachedpath, tigerpath in zip(cachedpaths, tigerpaths):
+            if not self.link_file(cachedpath, tigerpath):
+                return None
+        self.keys[datpath] = key
+        self.add(datpath, tigerpaths)
+        status('Unchanged, using', ', '.join(tigerpaths))
+        run_metrics.count('cached_master_files')
+        if (archive_dir in (None, '', '-')) or (outdir in (None, '-')):
+            return tigerpaths
+        archive_file(datpath, archive_dir, created_files=tigerpaths)
+        return tigerpaths
+
+    @property
+    def settings_hash(self):
+        """ A hash of the current settings. The 'tiger_settings' config may
+            be reloaded while Tiger Tamer is running (--watch, or the GUI).
+        """
+        return self.hash_settings(
+            extra_data=self.extra_data,
+            split_parts=self.split_parts,
+        )
+
+
+class DatInfoCache(JSONCache):
+    """ Remembers info about Mozaik (.dat) files, by file path.
+        Scanning only saves the first line's column count, the rest of the
+        info from `parser.get_dat_file_info()` is added when it's needed.
+        Entries are only used while the file's size and mtime haven't
+        changed.
+    """
+    default_filepath = DATINFOFILE
+    # Keys for the full info, from `parser.get_dat_file_info()`.
+    info_keys = ('columns', 'counts', 'lines', 'widths')
+    max_entries = DATINFO_MAX_ENTRIES
+    name = 'Mozaik file info cache'
+
+    def get(self, filepath, st, keys=('columns',)):
+        """ Returns the info for a file with this `os.stat_result`,
+            or None if it's not cached, has changed, or is missing any of
+            the `keys`.
+        """
+        entry = self.load().get(filepath, None)
+        if not entry:
+            return None
+        if entry.get('size', None) != st.st_size:
+            return None
+        if entry.get('mtime_ns', None) != st.st_mtime_ns:
+            return None
+        if not all(key in entry for key in keys):
+            return None
+        return entry
+
+    def add(self, filepath, st, info):
+        """ Remember the info for a file with this `os.stat_result`. """
+        entry = dict(info)
+        entry.update(size=st.st_size, mtime_ns=st.st_mtime_ns)
+        return self.set(filepath, entry)
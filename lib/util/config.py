@@ -5,9 +5,13 @@
     -Christopher Welborn 12-22-2018
 """
 
+import atexit
 import os
 import sys
+import threading
+from contextlib import contextmanager, suppress
 from platform import platform
+from time import sleep, time
 
 from colr import (
     auto_disable as colr_auto_disable,
@@ -32,6 +36,7 @@ SCRIPT = os.path.split(os.path.abspath(sys.argv[0]))[1]
 SCRIPTDIR = os.path.abspath(sys.path[0])
 
 CONFIGFILE = os.path.join(SCRIPTDIR, 'tigertamer.json')
+CONFIGLOCKFILE = '{}.lock'.format(CONFIGFILE)
 LOCKFILE = os.path.join(SCRIPTDIR, 'tigertamer.lock')
 ICONFILE = os.path.join(
     SCRIPTDIR,
@@ -46,6 +51,18 @@ PID = os.getpid()
 # Global JSONSettings() config object, available to other modules.
 config = None
 
+# Seconds to wait before saving buffered config_increment() values.
+INCREMENT_FLUSH_DELAY = 30
+# Seconds before another process's config file lock is considered stale.
+CONFIG_LOCK_TIMEOUT = 5
+
+# Buffered config_increment() values that haven't been saved yet.
+_increments = {}
+# Timer that will call config_flush(), if any increments are buffered.
+_increments_timer = None
+# Lock for config/_increments, for the GUI's threads.
+_config_lock = threading.RLock()
+
 
 class _NotSet(object):
     def __bool__(self):
@@ -62,6 +79,77 @@ class _NotSet(object):
 NotSet = _NotSet()
 
 
+@contextmanager
+def config_file_lock(timeout=CONFIG_LOCK_TIMEOUT):
+    """ Hold CONFIGLOCKFILE while reading/writing the config file, so other
+        Tiger Tamer processes don't overwrite each other's changes.
+        A lock file older than `timeout` seconds is considered stale.
+    """
+    fd = None
+    start = time()
+    while fd is None:
+        try:
+            fd = os.open(
+                CONFIGLOCKFILE,
+                os.O_CREAT | os.O_EXCL | os.O_WRONLY,
+            )
+        except FileExistsError:
+            if (time() - start) > timeout:
+                debug_err('Removing stale config lock: {}'.format(
+                    CONFIGLOCKFILE
+                ))
+                with suppress(FileNotFoundError):
+                    os.remove(CONFIGLOCKFILE)
+                start = time()
+                continue
+            sleep(0.05)
+        except EnvironmentError as ex:
+            # Can't lock, but the config may still be writable.
+            debug_err('Unable to lock config: {}'.format(ex))
+            break
+    try:
+        yield
+    finally:
+        if fd is not None:
+            os.close(fd)
+            with suppress(FileNotFoundError):
+                os.remove(CONFIGLOCKFILE)
+
+
+def config_flush():
+    """ Save any buffered config_increment() values.
+        The config is reloaded and the increments are added to the values
+        on disk, while holding the config file lock, so other windows and
+        processes don't lose their updates.
+        Returns True if the config was saved, or there was nothing to save.
+    """
+    global config, _increments_timer
+    with _config_lock:
+        if _increments_timer is not None:
+            _increments_timer.cancel()
+            _increments_timer = None
+        if not _increments:
+            return True
+        with config_file_lock():
+            config = config_load()
+            for key, value in _increments.items():
+                config[key] = config.get(key, 0) + value
+            debug('Saving {} config increment{}.'.format(
+                len(_increments),
+                '' if len(_increments) == 1 else 's',
+            ))
+            try:
+                config_write(config)
+            except EnvironmentError as ex:
+                debug_err('Unable to save config increments!: {}'.format(ex))
+                # Increments were applied to the reloaded config.
+                # Reload again, so they aren't counted twice.
+                config = config_load()
+                return False
+        _increments.clear()
+    return True
+
+
 def config_get(key, default=NotSet):
     """ Like config.get(), except it will load config if it hasn't been
         loaded yet.
@@ -75,20 +163,24 @@ def config_get(key, default=NotSet):
     except KeyError:
         if default is NotSet:
             raise
-        return default
+        val = default
+    with _config_lock:
+        pending = _increments.get(key, None)
+    if pending is not None:
+        # Include increments that haven't been saved yet.
+        val += pending
     return val
 
 
 def config_increment(**kwargs):
-    """ Retrieve a config key's value, and increment it by `value`,
-        then save the config.
+    """ Retrieve a config key's value, and increment it by `value`.
         Config keys/values are passed in by `kwargs`.
         A `default` key can be given, for default values.
+        Increments are buffered, and saved by `config_flush()` after
+        `INCREMENT_FLUSH_DELAY` seconds, or at exit.
     """
-    global config
-    default = kwargs.get('default', NotSet)
-    if default is not NotSet:
-        kwargs.pop('default')
+    global _increments_timer
+    default = kwargs.pop('default', NotSet)
 
     for key, value in kwargs.items():
         v = config_get(key, default)
@@ -107,7 +199,7 @@ def config_increment(**kwargs):
         )
 
         try:
-            config[key] = v + value
+            newv = v + value
         except Exception as ex:
             debug_err(
                 'Can\'t increment key \'{}\': ({}) {}'.format(
@@ -116,17 +208,25 @@ def config_increment(**kwargs):
                     ex)
             )
             return False
-        else:
-            debug(
-                ' Incremented: {k!r:>16} == {v!r}'.format(
-                    k=key,
-                    v=config[key],
-                ),
-                align=True,
-            )
+        with _config_lock:
+            _increments[key] = _increments.get(key, 0) + value
+        debug(
+            ' Incremented: {k!r:>16} == {v!r}'.format(
+                k=key,
+                v=newv,
+            ),
+            align=True,
+        )
 
-    # Multithreaded Tkinter windows are not using 'globals' like they should.
-    return config_save(config, sub_dict_ok=True)
+    with _config_lock:
+        if _increments and (_increments_timer is None):
+            _increments_timer = threading.Timer(
+                INCREMENT_FLUSH_DELAY,
+                config_flush,
+            )
+            _increments_timer.daemon = True
+            _increments_timer.start()
+    return True
 
 
 def config_load():
@@ -144,36 +244,53 @@ def config_load():
 
 def config_save(d=None, sub_dict_ok=False):
     global config
-    # Reload config from disk, because other threads may have changed it.
-    config = config_load()
-    subitemcnt = 0
-    if d:
-        for key, val in d.items():
-            if isinstance(val, dict):
-                subitemcnt += len(val)
-                if (not sub_dict_ok):
-                    debug_err(
-                        'Saving a dict in config for {!r}!: {!r}'.format(
-                            key,
-                            val,
-                        ),
-                        level=1,
-                    )
-        config.update(d)
-    # debug_obj(dict(config.items()), msg='Saving config:')
-    debug('Saving config (items: {}{})'.format(
-        len(d or config),
-        ' + {} sub-item{}'.format(
-            subitemcnt,
-            '' if subitemcnt == 1 else 's',
-        ) if subitemcnt else '',
-    ))
+    with _config_lock, config_file_lock():
+        # Reload config from disk, because other threads may have changed it.
+        config = config_load()
+        subitemcnt = 0
+        if d:
+            for key, val in d.items():
+                if isinstance(val, dict):
+                    subitemcnt += len(val)
+                    if (not sub_dict_ok):
+                        debug_err(
+                            'Saving a dict in config for {!r}!: {!r}'.format(
+                                key,
+                                val,
+                            ),
+                            level=1,
+                        )
+            config.update(d)
+        # debug_obj(dict(config.items()), msg='Saving config:')
+        debug('Saving config (items: {}{})'.format(
+            len(d or config),
+            ' + {} sub-item{}'.format(
+                subitemcnt,
+                '' if subitemcnt == 1 else 's',
+            ) if subitemcnt else '',
+        ))
+        try:
+            config_write(config)
+        except EnvironmentError as ex:
+            debug_err('Unable to save gui config!: {}'.format(ex))
+            return False
+        return True
+
+
+def config_write(c):
+    """ Write a JSONSettings config to CONFIGFILE by saving a temporary
+        file and replacing CONFIGFILE with it, so other processes never
+        load a half-written config.
+        Raises the same errors as JSONSettings.save() and os.replace().
+    """
+    tmpfile = '{}.{}.tmp'.format(CONFIGFILE, PID)
     try:
-        config.save(sort_keys=True)
-    except EnvironmentError as ex:
-        debug_err('Unable to save gui config!: {}'.format(ex))
-        return False
-    return True
+        c.save(filename=tmpfile, sort_keys=True)
+        os.replace(tmpfile, CONFIGFILE)
+    finally:
+        c.filename = CONFIGFILE
+        with suppress(FileNotFoundError):
+            os.remove(tmpfile)
 
 
 def get_system_info():
@@ -227,3 +344,7 @@ def lock_release():
     os.remove(LOCKFILE)
     debug('Lock released: {}'.format(LOCKFILE), level=1)
     return True
+
+
+# Save any buffered increments when exiting.
+atexit.register(config_flush)
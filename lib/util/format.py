@@ -7,10 +7,16 @@
 
 import os
 import sys
+from copy import deepcopy
+from io import BytesIO
 
 from lxml.builder import ElementMaker
 from lxml import etree as ElementTree
-from lxml.etree import tostring as et_tostring
+from lxml.etree import (
+    Element,
+    SubElement,
+    tostring as et_tostring,
+)
 
 from colr import (
     auto_disable as colr_auto_disable,
@@ -26,6 +32,7 @@ from .logger import (
     debug,
     debugprinter,
 )
+from .metrics import run_metrics
 
 colr_auto_disable()
 debugprinter.enable(('-D' in sys.argv) or ('--debug' in sys.argv))
@@ -37,61 +44,16 @@ E = ElementMaker(
     }
 )
 
-tigerconfig = config_get('tiger_settings', {})
-settings = {
-    'style': tigerconfig.get(
-        'style',
-        'Setpoint'
-    ),
-    'unit': tigerconfig.get(
-        'unit',
-        'English'
-    ),
-    'isOptimized': str(tigerconfig.get(
-        'isOptimized',
-        'true'
-    )).lower(),
-    'headCut': str(tigerconfig.get(
-        'headCut',
-        '0'
-    )),
-    'tailCut': str(tigerconfig.get(
-        'tailCut',
-        '0'
-    )),
-    'patternStockLength': str(tigerconfig.get(
-        'patternStockLength',
-        '0'
-    )),
-    'sequenceNumber': str(tigerconfig.get(
-        'sequenceNumber',
-        '1'
-    )),
-    'sortString': tigerconfig.get(
-        'sortString',
-        None
-    ),
-    'sendFileName': str(tigerconfig.get(
-        'sendFileName',
-        'true'
-    )).lower(),
-    'quantityMultiples': str(tigerconfig.get(
-        'quantityMultiples',
-        'false'
-    )).lower(),
-    'isInfinite': str(tigerconfig.get(
-        'isInfinite',
-        'false'
-    )).lower(),
-    'isCascade': str(tigerconfig.get(
-        'isCascade',
-        'false'
-    )).lower(),
-    'labels': tigerconfig.get(
-        'labels',
-        [],
-    ),
-}
+# TigerStop settings from config, built on first use by tiger_settings().
+_settings = None
+# A copy of the 'tiger_settings' config that _settings was built from, so
+# changes (like when config is reloaded) are noticed.
+_settings_config = None
+# Rendered CutList header, (before fname, after fname), built on first use by
+# create_header(). Only the file name changes between tiger files.
+_header = None
+# Placeholder file name, for splitting the rendered header.
+HEADER_FNAME = 'TIGERTAMER_FNAME'
 
 # Labels that are available to be used, in the correct order for use with
 # TigerFile columns.
@@ -101,18 +63,36 @@ available_labels = ('index', 'part', 'no', 'note')
 
 
 def create_xml(mozfile, extra_data=False):
-    return '\n'.join((
-        '<?xml version="1.0" encoding="utf-8"?>',
-        et_tostring(
-            E.CutList(
-                *create_settings(mozfile.filepath, extra_data=extra_data),
-                E.pieces(
-                    *create_pieces(mozfile.parts, extra_data=extra_data),
-                ),
-            ),
+    """ Returns the XML for a tiger file, as a str. """
+    with run_metrics.timer('create_xml'):
+        return ''.join(iter_xml(mozfile, extra_data=extra_data))
+
+
+def create_header(filepath, extra_data=False):
+    """ Returns the XML for the CutList start tag and settings (everything
+        before <pieces>), as a pretty-printed str.
+        Everything but the file name is rendered once, and reused until
+        the settings change.
+    """
+    global _header
+    # Forgets the header if the 'tiger_settings' config has changed.
+    tiger_settings()
+    if _header is None:
+        cutlist = et_tostring(
+            E.CutList(*create_settings(HEADER_FNAME, extra_data=extra_data)),
             pretty_print=True,
-        ).decode(),
-    ))
+        ).decode()
+        before, after = cutlist.split(
+            '<fname>{}</fname>'.format(HEADER_FNAME),
+            1,
+        )
+        # Everything but the closing </CutList>.
+        _header = before, after[:after.rindex('</CutList>')]
+        debug('Rendered tiger file header.')
+    tigername, _ = os.path.splitext(filepath)
+    fname = Element('fname')
+    fname.text = tigername
+    return et_tostring(fname).decode().join(_header)
 
 
 def create_labels():
@@ -130,20 +110,20 @@ def create_labels():
 
 
 def create_piece(mozpart, index, extra_data=False):
-    part_strs = [
-        E.string(str(index)),
-        E.string(mozpart.type),
-        E.string(mozpart.no),
-    ]
+    # Built with SubElement, which is much faster than ElementMaker for
+    # the thousands of pieces in a large file. Pieces don't need the
+    # namespace map, the CutList declares it.
+    piece = Element('Piece')
+    labelstrings = SubElement(piece, 'labelStrings')
+    part_strs = [str(index), mozpart.type, mozpart.no]
     if extra_data:
-        part_strs.append(E.string(mozpart.extra_data))
-
-    return E.Piece(
-        E.labelStrings(*part_strs),
-        E.length(mozpart.length),
-        E.quantity(str(mozpart.count)),
-        E.completed('0'),
-    )
+        part_strs.append(mozpart.extra_data)
+    for part_str in part_strs:
+        SubElement(labelstrings, 'string').text = part_str
+    SubElement(piece, 'length').text = mozpart.length
+    SubElement(piece, 'quantity').text = str(mozpart.count)
+    SubElement(piece, 'completed').text = '0'
+    return piece
 
 
 def create_pieces(mozparts, extra_data=False):
@@ -157,7 +137,7 @@ def create_pieces(mozparts, extra_data=False):
 
 def create_settings(filepath, extra_data=False):
     tigername, _ = os.path.splitext(filepath)
-
+    settings = tiger_settings()
     return (
         E.style(settings['style']),
         E.unit(settings['unit']),
@@ -192,11 +172,43 @@ def default_labels():
     )
 
 
+def iter_xml(mozfile, extra_data=False):
+    """ Yields the XML for a tiger file in pieces, so large files can be
+        written without building the whole element tree/string at once.
+        The output is the same as serializing the whole tree with
+        `pretty_print=True`. Each piece is serialized inside an empty
+        CutList/pieces wrapper so lxml indents it at the right level, and
+        the wrapper lines are dropped.
+    """
+    yield '<?xml version="1.0" encoding="utf-8"?>\n'
+    yield create_header(mozfile.filepath, extra_data=extra_data)
+
+    pieces = E.pieces()
+    wrapper = E.CutList(pieces)
+    # The wrapper's lines that are dropped from each serialized piece.
+    start = None
+    end = -len('  </pieces>\n</CutList>\n')
+    for piece in create_pieces(mozfile.parts, extra_data=extra_data):
+        pieces.append(piece)
+        xml = et_tostring(wrapper, pretty_print=True).decode()
+        pieces.remove(piece)
+        if start is None:
+            yield '  <pieces>\n'
+            start = xml.index('<Piece')
+            start = xml.rindex('\n', 0, start) + 1
+        yield xml[start:end]
+    if start is None:
+        yield '  <pieces/>\n'
+    else:
+        yield '  </pieces>\n'
+    yield '</CutList>\n'
+
+
 def label_config_get(use_display_order=False):
     """ Build label info, either from user config or default_labels.
         Ensures that values are stringified.
     """
-    labels = settings.get('labels', [])
+    labels = tiger_settings().get('labels', [])
     if labels:
         debug('Using labels from config.')
     else:
@@ -216,8 +228,10 @@ def label_config_get(use_display_order=False):
 
 def label_config_save(lbl_config):
     """ Save label config in the configuration file. """
+    settings = tiger_settings()
     settings['labels'] = lbl_config or {}
     config_save({'tiger_settings': settings}, sub_dict_ok=True)
+    settings_changed()
 
 
 def list_labelconfig():
@@ -233,6 +247,84 @@ def list_labelconfig():
     return 0
 
 
+def settings_changed():
+    """ Forget the rendered tiger file header, and the settings it was
+        built from, so they are rebuilt from config on next use.
+        This must be called after changing the 'tiger_settings' config.
+    """
+    global _header, _settings
+    _header = None
+    _settings = None
+
+
+def tiger_settings():
+    """ Returns the TigerStop settings dict. It is built from the
+        'tiger_settings' config on first use, so importing this module
+        does not load the config, and rebuilt when that config changes.
+    """
+    global _header, _settings, _settings_config
+    tigerconfig = config_get('tiger_settings', {})
+    if (_settings is None) or (tigerconfig != _settings_config):
+        # The header is rendered from these settings.
+        _header = None
+        _settings_config = deepcopy(tigerconfig)
+        _settings = {
+            'style': tigerconfig.get(
+                'style',
+                'Setpoint'
+            ),
+            'unit': tigerconfig.get(
+                'unit',
+                'English'
+            ),
+            'isOptimized': str(tigerconfig.get(
+                'isOptimized',
+                'true'
+            )).lower(),
+            'headCut': str(tigerconfig.get(
+                'headCut',
+                '0'
+            )),
+            'tailCut': str(tigerconfig.get(
+                'tailCut',
+                '0'
+            )),
+            'patternStockLength': str(tigerconfig.get(
+                'patternStockLength',
+                '0'
+            )),
+            'sequenceNumber': str(tigerconfig.get(
+                'sequenceNumber',
+                '1'
+            )),
+            'sortString': tigerconfig.get(
+                'sortString',
+                None
+            ),
+            'sendFileName': str(tigerconfig.get(
+                'sendFileName',
+                'true'
+            )).lower(),
+            'quantityMultiples': str(tigerconfig.get(
+                'quantityMultiples',
+                'false'
+            )).lower(),
+            'isInfinite': str(tigerconfig.get(
+                'isInfinite',
+                'false'
+            )).lower(),
+            'isCascade': str(tigerconfig.get(
+                'isCascade',
+                'false'
+            )).lower(),
+            'labels': tigerconfig.get(
+                'labels',
+                [],
+            ),
+        }
+    return _settings
+
+
 class TigerFile(object):
     """ A tiger file (XML, .tiger) constructed from a file or XML string with
         a header and a parts list.
@@ -243,6 +335,15 @@ class TigerFile(object):
             others are from the user's printStrings/labelField/labelStrings.
 
     """
+    # Types for values, by lower-case header/tag name. Others are str.
+    column_types = {
+        'completed': int,
+        'count': int,
+        'index': int,
+        'length': float,
+        'quantity': int,
+    }
+
     def __init__(self, filepath=None, parts=None):
         self.filepath = filepath or None
         self.parts = parts or []
@@ -250,9 +351,10 @@ class TigerFile(object):
         self.header_ts = ['Quantity', 'Completed', 'Length']
         # Header values added by the user through labelStrings.
         self.header_user = None
-        # Final header for display, set in self.from_bytes().
+        # Final header for display, set in self.iter_parts().
         self.header = None
-        self.root = None
+        # Converters for user header values, set in self.iter_parts().
+        self.converters = None
 
     def __colr__(self):
         """ Format this TigerFile as a Colr when passed directly to Colr().
@@ -310,12 +412,11 @@ class TigerFile(object):
             ),
         )
 
-    def _build_headers(self, rootelem):
-        """ Set self.header with values from `header_ts` and `header_user`,
-            calling `_parse_user_headers()` to get them.
+    def _build_headers(self, user_headers):
+        """ Set self.header with values from `header_ts` and `header_user`.
+            Also sets the `converters` used for each <Piece>.
         """
-        # Get user headers.
-        self.header_user = self._parse_user_headers(rootelem)
+        self.header_user = user_headers
         if not self.header_user:
             raise ValueError(
                 'No user headers!: {!r}'.format(self.header_user)
@@ -328,72 +429,118 @@ class TigerFile(object):
             skip = 0
         self.header.extend(self.header_ts)
         self.header.extend(self.header_user[skip:])
+        # Converters for each <string> in <labelStrings>.
+        self.converters = [
+            self.column_types.get(lbl.lower(), None)
+            for lbl in self.header_user
+        ]
 
     @classmethod
     def from_file(cls, filepath):
-        with open(filepath, 'rb') as f:
-            tf = cls.from_bytes(f.read())
-            tf.filepath = filepath
+        """ Create a TigerFile from a .tiger file path. """
+        tf = cls(filepath=filepath)
+        tf.parts = list(tf.iter_parts(filepath))
         return tf
 
     @classmethod
     def from_bytes(cls, b, filepath=None):
         """ Create a TigerFile from XML bytes (a .tiger file's content). """
         tf = cls(filepath=filepath)
-        root = ElementTree.fromstring(b)
-
-        tf._build_headers(root)
-        tf.parts = tf._parse_pieces(root)
+        tf.parts = list(tf.iter_parts(BytesIO(b)))
         return tf
 
     @classmethod
-    def from_mozfile(cls, mozfile):
-        """ Creates a TigerFile from a MozaikFile instance. """
-        return cls.from_bytes(
-            create_xml(mozfile).encode(),
-            filepath=mozfile.filepath,
-        )
+    def from_mozfile(cls, mozfile, extra_data=False):
+        """ Creates a TigerFile from a MozaikFile instance.
+            The parts are built directly from the MozaikFile, with the same
+            values as they would have in a tiger file, without rendering and
+            parsing the XML.
+        """
+        tf = cls(filepath=mozfile.filepath)
+        user_headers = []
+        for name, _ in label_config_get():
+            # Same as <column> in create_labels().
+            user_headers.insert(available_labels.index(name), name.title())
+        tf._build_headers(user_headers)
+        tf.parts = []
+        for index, mozpart in enumerate(
+                sorted(mozfile.parts, key=lambda p: p.no), start=1):
+            # Same as the <labelStrings> in create_piece().
+            strings = [str(index), mozpart.type, mozpart.no]
+            if extra_data:
+                strings.append(mozpart.extra_data)
+            tf.parts.append(
+                tf._create_part(
+                    # Empty strings are empty elements, with no text.
+                    [s or None for s in strings],
+                    {
+                        'length': mozpart.length or None,
+                        'quantity': str(mozpart.count),
+                        'completed': '0',
+                    },
+                )
+            )
+        return tf
 
-    def _parse_pieces(self, rootelem):
-        # Parse parts in <pieces><Piece>..</Piece>..</pieces>
+    def _create_part(self, strings, pieceinfo):
+        """ Create a TigerPart from <labelStrings> values and other <Piece>
+            values ({tag: text}), converting each value with the converter
+            for it's column.
+        """
         if not self.header_user:
             raise ValueError('Headers not set (needs _build_headers())!')
-
-        parts = []
-        for piece in rootelem.iter('Piece'):
-            partinfo = {
-                'length': piece.find('length').text,
-                'quantity': int(piece.find('quantity').text),
-                'completed': int(piece.find('completed').text),
-
-            }
-            lblstrs = piece.find('labelStrings')
-            # Expecting Index, Part, No, and optional Note <string>s.
-            userstrs = [
-                (i, string.text)
-                for i, string in enumerate(lblstrs.findall('string'))
-            ]
-            for index, value in userstrs:
-                lbl = self.header_user[index]
-                if lbl.lower() in ('index', 'count'):
-                    value = int(value)
-                partinfo[lbl] = value
-
-            parts.append(TigerPart(partinfo))
-        return parts
-
-    @classmethod
-    def _parse_user_headers(cls, rootelem):
-        """ Grab all <header>s from <printStrings>, and return the text
-            in a list, using <column> for the list index.
-            Returns a list of user headers from a .tiger file root element.
+        partinfo = {}
+        # Expecting Index, Part, No, and optional Note <string>s.
+        for i, value in enumerate(strings):
+            converter = self.converters[i]
+            if (converter is not None) and (value is not None):
+                value = converter(value)
+            partinfo[self.header_user[i]] = value
+        for tag, value in pieceinfo.items():
+            converter = self.column_types.get(tag, None)
+            if (converter is not None) and (value is not None):
+                value = converter(value)
+            partinfo[tag] = value
+        return TigerPart(partinfo, converted=True)
+
+    def _parse_piece(self, piece):
+        """ Parse a <Piece> element into a TigerPart. """
+        strings = []
+        pieceinfo = {}
+        for elem in piece:
+            if elem.tag == 'labelStrings':
+                strings.extend(string.text for string in elem)
+            else:
+                pieceinfo[elem.tag] = elem.text
+        return self._create_part(strings, pieceinfo)
+
+    def iter_parts(self, source):
+        """ Parse a .tiger file (file path or file object), yielding
+            TigerParts one at a time.
+            Elements are cleared as they are parsed, so memory use doesn't
+            grow with the size of the file. The headers are set from
+            <printStrings> before the first part is yielded.
         """
-
         user_headers = []
-        for lblfield in rootelem.find('printStrings'):
-            index = int(lblfield.find('column').text)
-            user_headers.insert(index, lblfield.find('header').text)
-        return user_headers
+        for _, elem in ElementTree.iterparse(
+                source, events=('end', ), tag=('LabelField', 'Piece')):
+            if elem.tag == 'LabelField':
+                # Use <column> for the header's index.
+                user_headers.insert(
+                    int(elem.findtext('column')),
+                    elem.findtext('header'),
+                )
+            else:
+                if self.header_user is None:
+                    self._build_headers(user_headers)
+                yield self._parse_piece(elem)
+            elem.clear()
+            # Remove references to elements that were already parsed.
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
+        if self.header_user is None:
+            # No pieces.
+            self._build_headers(user_headers)
 
     def print(self):
         """ Print a console-friendly version of this TigerFile. """
@@ -423,12 +570,14 @@ class TigerPart(object):
     # in the initialization dict.
     header = ['Index', 'Quantity', 'Completed', 'Length', 'Part', 'No']
 
-    def __init__(self, data):
+    def __init__(self, data, converted=False):
         """ Initialize a TigerPart with a dict of {lbl: val}, where lbl is
             in TigerFile.header.
+            Values are converted to int, float, or str, unless `converted`
+            is truthy.
         """
         for key, val in data.items():
-            if val is not None:
+            if (val is not None) and (not converted):
                 try:
                     val = int(val)
                 except ValueError:
@@ -481,6 +630,19 @@ class TigerPart(object):
 
     def __str__(self):
         return ', '.join(
-            '{}: {}'.format(key, getattr(self, key.lower(), None))
+            '{}: {}'.format(key, self.format_value(getattr(
+                self,
+                key.lower(),
+                None,
+            )))
             for key in self.header
         )
+
+    @staticmethod
+    def format_value(value):
+        """ Format a value for __str__. Whole floats (Length) are shown
+            without the .0, as they are in the tiger file.
+        """
+        if isinstance(value, float) and value.is_integer():
+            return str(int(value))
+        return str(value)
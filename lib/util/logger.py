@@ -32,6 +32,9 @@ SCRIPT = os.path.split(os.path.abspath(sys.argv[0]))[1]
 SCRIPTDIR = os.path.abspath(sys.path[0])
 
 LOGFILE = os.path.join(SCRIPTDIR, 'tigertamer.log')
+# Environment variable that is set for worker processes
+# (see parser.convert_moz_files), so they don't start a new log file.
+WORKER_ENV_VAR = 'TIGERTAMER_WORKER'
 DEBUG = False
 debugprinter = DebugPrinter()
 if not getattr(debugprinter, 'debug_err', None):
@@ -52,7 +55,12 @@ formatter = logging.Formatter(
 )
 formatter.default_time_format = '%m-%e-%y'  # '%I:%M:%S%p'
 
-filehandler = logging.FileHandler(filename=LOGFILE, mode='w')
+if not os.environ.get(WORKER_ENV_VAR, None):
+    # Start a new log file for each run. The log is opened in append mode,
+    # so worker processes (see parser.convert_moz_files) can share it.
+    with open(LOGFILE, 'w'):
+        pass
+filehandler = logging.FileHandler(filename=LOGFILE, mode='a')
 filehandler.setFormatter(formatter)
 logger.addHandler(filehandler)
 logger.setLevel(logging.ERROR)
@@ -62,6 +70,9 @@ def _debug(*args, **kwargs):
     iserror = False
     with suppress(KeyError):
         iserror = kwargs.pop('is_error')
+    if not debug_enabled(is_error=iserror):
+        # Nothing would be printed or logged, skip the line info/formatting.
+        return None
     kwargs['level'] = kwargs.get('level', 0) + 1
     if sys.stderr.isatty():
         if iserror:
@@ -110,6 +121,16 @@ def debug_attrs(o):
         )
 
 
+def debug_enabled(is_error=False):
+    """ Returns True if a debug()/debug_err() message would be printed or
+        logged. This is checked before any stack inspection or formatting is
+        done.
+    """
+    if debugprinter.enabled and sys.stderr.isatty():
+        return True
+    return logger.isEnabledFor(logging.ERROR if is_error else logging.DEBUG)
+
+
 def debug_err(*args, **kwargs):
     kwargs['is_error'] = True
     kwargs['level'] = kwargs.get('level', 0) + 1
@@ -299,3 +320,31 @@ def str_contains(s, substrs):
             type(substrs).__name__,
         )))
     return False
+
+
+class LazyMsg(object):
+    """ A message for debug()/debug_err() that is not formatted until it is
+        actually printed or logged.
+        Usage:
+            debug(LazyMsg('Single part: {}', part))
+        ...is like `debug('Single part: {}'.format(part))`, except
+        `str.format()` (and `str(part)`) is never called when debugging is
+        disabled.
+    """
+    __slots__ = ('fmt', 'args', 'kwargs')
+
+    def __init__(self, fmt, *args, **kwargs):
+        self.fmt = fmt
+        self.args = args
+        self.kwargs = kwargs
+
+    def __repr__(self):
+        return '{}({!r}, args={!r}, kwargs={!r})'.format(
+            type(self).__name__,
+            self.fmt,
+            self.args,
+            self.kwargs,
+        )
+
+    def __str__(self):
+        return self.fmt.format(*self.args, **self.kwargs)
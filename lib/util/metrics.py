@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+
+""" tigertamer - lib/util/metrics.py
+    Timers and counters for each phase of a Tiger Tamer run, saved as JSON
+    so slow runs can be explained (scanning, parsing, combining, rendering,
+    writing, or archiving).
+    -Christopher Welborn 10-16-2026
+"""
+
+import json
+import os
+from contextlib import contextmanager, suppress
+from datetime import datetime
+from time import perf_counter
+
+from colr import (
+    auto_disable as colr_auto_disable,
+    Colr as C,
+)
+
+from .config import (
+    PID,
+    SCRIPTDIR,
+    VERSION,
+)
+from .logger import (
+    debug,
+    debug_err,
+)
+
+colr_auto_disable()
+
+# Metrics for the last run are saved here, next to tigertamer.log.
+METRICSFILE = os.path.join(SCRIPTDIR, 'tigertamer_metrics.json')
+
+# Timer names, in the order they happen, with a description for --stats.
+METRIC_PHASES = (
+    ('scan', 'Scanning for master files'),
+    ('parse', 'Parsing/splitting parts'),
+    ('width_files', 'Separating width files'),
+    ('combine_parts', 'Combining parts'),
+    ('create_xml', 'Rendering XML'),
+    ('write', 'Writing tiger files'),
+    ('archive', 'Archiving master files'),
+)
+
+
+class RunMetrics(object):
+    """ Accumulates timers and counters for a single run.
+        Timers can be nested, and each timer only counts the time that
+        wasn't spent in another timer, so phase times add up to the total.
+    """
+    def __init__(self):
+        self.counts = {}
+        self.times = {}
+        # Timers that are running, [[name, start_time, child_seconds], ..].
+        self.running = []
+        self.time_start = perf_counter()
+        self.date = datetime.now()
+
+    def __repr__(self):
+        return '{}(counts={!r}, times={!r})'.format(
+            type(self).__name__,
+            self.counts,
+            self.times,
+        )
+
+    def add_time(self, name, seconds):
+        """ Add `seconds` to a timer. If another timer is running, the time
+            is subtracted from it.
+        """
+        self.times[name] = self.times.get(name, 0) + seconds
+        if self.running:
+            self.running[-1][2] += seconds
+
+    def count(self, name, value=1):
+        """ Increment a counter by `value`. """
+        self.counts[name] = self.counts.get(name, 0) + value
+
+    def merge(self, info):
+        """ Add counts/times from another RunMetrics' `to_dict()`, like
+            from a worker process.
+            Worker processes run at the same time, so their phase times
+            can add up to more than the total run time.
+        """
+        for name, value in info.get('counts', {}).items():
+            self.count(name, value)
+        for name, seconds in info.get('times', {}).items():
+            self.add_time(name, seconds)
+
+    def reset(self):
+        """ Forget all counts/times, and start timing a new run. """
+        self.__init__()
+
+    def save(self, filepath=None):
+        """ Save these metrics as JSON.
+            Returns True on success.
+        """
+        filepath = filepath or METRICSFILE
+        tmpfile = '{}.{}.tmp'.format(filepath, PID)
+        try:
+            with open(tmpfile, 'w') as f:
+                json.dump(self.to_dict(), f, indent=4, sort_keys=True)
+            os.replace(tmpfile, filepath)
+        except EnvironmentError as ex:
+            debug_err('Unable to save metrics: {}\n{}'.format(filepath, ex))
+            return False
+        finally:
+            with suppress(FileNotFoundError):
+                os.remove(tmpfile)
+        debug('Saved run metrics: {}'.format(filepath))
+        return True
+
+    def summary_lines(self):
+        """ Yield lines summarizing these metrics for --stats. """
+        info = self.to_dict()
+        total = info['total_secs']
+        yield str(C(': ').join(
+            C('Run time', 'cyan'),
+            C('{:0.3f}s'.format(total), 'blue', style='bright'),
+        ))
+        for name, desc in METRIC_PHASES:
+            seconds = info['times'].get(name, None)
+            if seconds is None:
+                continue
+            yield '    {:<28} {:>9.3f}s {:>6.1f}%'.format(
+                desc,
+                seconds,
+                (seconds / total) * 100 if total else 0,
+            )
+        for name in sorted(info['counts']):
+            yield '    {:<28} {:>10}'.format(
+                name.replace('_', ' ').capitalize(),
+                info['counts'][name],
+            )
+        for name in sorted(info['rates']):
+            yield '    {:<28} {:>12.1f}'.format(
+                name.replace('_', ' ').capitalize(),
+                info['rates'][name],
+            )
+
+    @contextmanager
+    def timer(self, name):
+        """ Time a block of code, adding to the `name` timer. """
+        frame = [name, perf_counter(), 0]
+        self.running.append(frame)
+        try:
+            yield
+        finally:
+            self.running.pop()
+            elapsed = perf_counter() - frame[1]
+            self.times[name] = self.times.get(name, 0) + elapsed - frame[2]
+            if self.running:
+                self.running[-1][2] += elapsed
+
+    def timed_iter(self, name, iterable):
+        """ Yield from an iterable, adding the time spent getting items to
+            the `name` timer.
+            The time is added when the iterable is exhausted, so it's
+            subtracted from whichever timer was running while it was used.
+        """
+        elapsed = 0
+        iterator = iter(iterable)
+        try:
+            while True:
+                start = perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    elapsed += perf_counter() - start
+                    return
+                elapsed += perf_counter() - start
+                yield item
+        finally:
+            self.add_time(name, elapsed)
+
+    def to_dict(self):
+        """ Returns the metrics as a dict, ready for JSON. """
+        total = perf_counter() - self.time_start
+        rates = {}
+        if total:
+            for name in ('bytes_written', 'parts'):
+                if name in self.counts:
+                    ratename = '{}_per_sec'.format(name)
+                    rates[ratename] = self.counts[name] / total
+        return {
+            'counts': dict(self.counts),
+            'date': '{:%Y-%m-%d %H:%M:%S}'.format(self.date),
+            'rates': rates,
+            'times': dict(self.times),
+            'total_secs': total,
+            'version': VERSION,
+        }
+
+
+# Global metrics for the current run, available to other modules.
+run_metrics = RunMetrics()
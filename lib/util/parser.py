@@ -11,6 +11,7 @@ import re
 import sys
 from collections import UserDict
 from contextlib import suppress
+from functools import lru_cache, partial
 
 from colr import (
     auto_disable as colr_auto_disable,
@@ -19,60 +20,141 @@ from colr import (
 
 from .archive import (
     archive_file,
-    increment_file_path,
+    open_new_file,
 )
+from .cache import DatInfoCache
 
 from .logger import (
     debug,
     debug_err,
+    get_debug_mode,
+    LazyMsg,
     print_err,
+    set_debug_mode,
     status,
+    WORKER_ENV_VAR,
 )
-from .format import create_xml
+from .metrics import run_metrics
+# .format (and lxml) is imported by the functions that render XML, so
+# names-only/tree/master file output doesn't need it.
 
 colr_auto_disable()
 
 
 # Pattern to grab one or more quantities from a room/cab number.
 cab_multi_count_pat = re.compile(r'\((\d{1,3})\)')
+# Number of distinct cab `no` strings to keep parsed, per process.
+CAB_NO_CACHE_SIZE = 4096
+
+
+@lru_cache(maxsize=CAB_NO_CACHE_SIZE)
+def get_cab_count(cabno, multi_allowed=False):
+    """ Parse out multiple cab counts from a `no` string (like: R1:1(2)).
+        Returns the number inside the parenthesis or 1.
+        Results are cached, so any debug messages are only shown the first
+        time a `cabno` is seen.
+    """
+    allcounts = cab_multi_count_pat.findall(cabno)
+    if allcounts:
+        cabcount = sum(int(s) for s in allcounts)
+        debug(
+            LazyMsg(
+                'Found multi {}: {} in {!r}',
+                'count' if len(allcounts) == 1 else 'counts',
+                cabcount,
+                cabno,
+            )
+        )
+        return cabcount
+
+    if ('(' in cabno):
+        if ((' ' in cabno) or ('&' in cabno)) and multi_allowed:
+            debug(LazyMsg('Missed cab count for multi-room: {!r}', cabno))
+        else:
+            debug_err(
+                'Missed cab count?: {!r}'.format(cabno),
+                file=sys.stderr,
+            )
+            debug_err(
+                '<-- get_cab_count() called from.',
+                level=1,
+                file=sys.stderr,
+            )
+    return 1
+
+
+def get_dat_file_columns(filepath):
+    """ Returns the column count for the first line of a Mozaik (.dat)
+        file, without reading the rest of it.
+        Empty files have 0 columns.
+    """
+    with open(filepath, 'r') as f:
+        line = f.readline()
+    for row in csv.reader([line]):
+        return len(row)
+    return 0
+
+
+def get_dat_file_info(filepath):
+    """ Read a Mozaik (.dat) file, and return a dict with the column count
+        of the first line, the line count, the (stripped) widths that are
+        used, and the total part quantity for each width file that would be
+        created, like {width: quantity}.
+        Raises ValueError for lines that can't be converted (a bad column
+        count or part count), like `MozaikMasterFile.parse_row()` does.
+    """
+    columns = None
+    lines = 0
+    widths = set()
+    counts = {}
+    header = MozaikMasterFile.header
+    countindex = header.index('count')
+    noindex = header.index('no')
+    widthindex = header.index('width')
+    with open(filepath, 'r') as f:
+        for row in csv.reader(f):
+            if columns is None:
+                columns = len(row)
+            lines += 1
+            if len(row) != len(header):
+                raise ValueError(
+                    'Invalid number of columns on line {}: ({}) {!r}'.format(
+                        lines,
+                        len(row),
+                        row,
+                    )
+                )
+            try:
+                count = get_part_count(row[countindex], row[noindex])
+            except ValueError as ex:
+                raise ValueError('Invalid count on line {}: {}'.format(
+                    lines,
+                    ex,
+                ))
+            width = row[widthindex].strip()
+            widths.add(width)
+            counts[width] = counts.get(width, 0) + count
+    return {
+        'columns': columns or 0,
+        'counts': counts,
+        'lines': lines,
+        'widths': sorted(widths),
+    }
 
 
 def get_dir_files(
-        dirpath, ignore_dirs=None, ignore_strs=None, ext='.dat', _level=0):
-    """ Loads all MozaikFiles contained in a directory. """
-    indent = '  ' * _level
-    debug('{}Looking for {} files in: {}'.format(
-        indent,
-        ext,
-        dirpath
-    ))
-    diritems = [
-        os.path.join(dirpath, s)
-        for s in os.listdir(dirpath)
-    ]
-    datfiles = []
-    for diritem in diritems:
-        ignore = is_ignored_dir(
-            diritem,
+        dirpath, ignore_dirs=None, ignore_strs=None, ext='.dat', scanner=None):
+    """ Returns all valid Mozaik file paths contained in a directory, and
+        it's sub-directories.
+        A DatFileScanner can be given to share counts between calls.
+    """
+    if scanner is None:
+        scanner = DatFileScanner(
             ignore_dirs=ignore_dirs,
             ignore_strs=ignore_strs,
+            ext=ext,
         )
-        if ignore:
-            continue
-        if diritem.endswith(ext):
-            if is_valid_dat_file(diritem, _indent=indent):
-                debug('{}Found {} file: {}'.format(indent, ext, diritem))
-                datfiles.append(diritem)
-        elif os.path.isdir(diritem):
-            datfiles.extend(
-                get_dir_files(
-                    diritem,
-                    ignore_dirs=ignore_dirs,
-                    ignore_strs=ignore_strs,
-                    ext=ext,
-                    _level=_level + 1,
-                )
-            )
+    datfiles = scanner.scan(dirpath)
     filelen = len(datfiles)
     debug('Found {} {}.'.format(
         filelen,
@@ -81,6 +163,19 @@ def get_dir_files(
     return datfiles
 
 
+def get_part_count(count, no):
+    """ Returns the count that a MozaikMasterPart would have for the
+        `count` and `no` columns of a Mozaik line, without creating one.
+        Multi-room/multi-cab counts are fixed like
+        `MozaikMasterPart.fix_cab_count()` does.
+        Raises ValueError for a bad `count`.
+    """
+    cabs = parse_cab_no(no.strip()) if no.strip() else ()
+    if len(cabs) > 1:
+        return sum(cabcount for _, _, cabcount in cabs)
+    return int(count)
+
+
 def get_tiger_files(outdir):
     """ Return a list of .tiger files in a directory. """
     try:
@@ -97,60 +192,169 @@ def get_tiger_files(outdir):
 
 
 def is_ignored_dir(dirpath, ignore_dirs=None, ignore_strs=None):
-    """ Return True if this `dirpath` should be ignored. """
-    if not (ignore_dirs or ignore_strs):
-        return False
-    if not ignore_dirs:
-        ignore_dirs = []
-    if ignore_strs:
-        ignore_strs = [s.lower() for s in ignore_strs]
-    else:
-        ignore_strs = []
-    dirpathlower = dirpath.lower()
-    for s in ignore_strs:
-        if s in dirpathlower:
-            debug('Ignoring matched string ({!r}): {}'.format(s, dirpath))
-            return True
-
-    if dirpath.rstrip('/') in ignore_dirs:
-        debug('Ignoring matched dir: {}'.format(dirpath))
-        return True
-    for ignorepath in ignore_dirs:
-        if dirpath.startswith(ignorepath):
-            debug('Ignoring partial-match dir: {}'.format(dirpath))
-            return True
-    return False
+    """ Return True if this `dirpath` should be ignored.
+        Use an IgnoreMatcher when checking many paths.
+    """
+    return IgnoreMatcher(ignore_dirs=ignore_dirs, ignore_strs=ignore_strs)(
+        dirpath
+    )
 
 
 def is_valid_dat_file(filepath, _indent=''):
     """ Returns True if this file has the proper column count for a .dat
         file.
     """
-    validlen = len(MozaikMasterFile.header)
     with open(filepath, 'r') as f:
         # read only the first line.
         for row in csv.reader([f.readline()]):
-            collen = len(row)
-            if collen != validlen:
-                debug_err(
-                    '{}Invalid column count (Need {}, Got {}): {}'.format(
-                        _indent,
-                        validlen,
-                        collen,
-                        filepath
+            return is_valid_column_count(len(row), filepath, _indent=_indent)
+    return True
+
+
+def is_valid_column_count(collen, filepath, _indent=''):
+    """ Returns True if `collen` (from the first line of `filepath`) is the
+        proper column count for a .dat file.
+    """
+    validlen = len(MozaikMasterFile.header)
+    if collen != validlen:
+        debug_err(
+            '{}Invalid column count (Need {}, Got {}): {}'.format(
+                _indent,
+                validlen,
+                collen,
+                filepath
+            )
+        )
+        return False
+    return True
+
+
+def convert_moz_file(filepath, split_parts=True, extra_data=False):
+    """ Load a single MozaikMasterFile, split it into width files, and
+        render the XML for each one.
+        This is safe to run in a worker process, nothing is written to disk.
+        Returns a list of [(MozaikFile, xml_str), ..].
+    """
+    from .format import create_xml
+    return [
+        (mozfile, create_xml(mozfile, extra_data=extra_data))
+        for mozfile in load_moz_file(filepath, split_parts=split_parts)
+    ]
+
+
+def convert_moz_file_worker(filepath, split_parts=True, extra_data=False):
+    """ Like `convert_moz_file`, for worker processes.
+        Returns (converted, metrics), where `metrics` is a dict of the
+        worker's run metrics for this file, to merge into the main
+        process' run metrics.
+    """
+    run_metrics.reset()
+    converted = convert_moz_file(
+        filepath,
+        split_parts=split_parts,
+        extra_data=extra_data,
+    )
+    return converted, run_metrics.to_dict()
+
+
+def convert_moz_files(filepaths, jobs=1, split_parts=True, extra_data=False):
+    """ Like `convert_moz_file`, for several master file paths.
+        With `jobs` > 1, master files are converted in a pool of worker
+        processes.
+        Results are yielded in the same order as `filepaths` either way,
+        so output file names are deterministic.
+        Yields (MozaikFile, xml_str) for every width file.
+    """
+    if (jobs < 2) or (len(filepaths) < 2):
+        for filepath in filepaths:
+            yield from convert_moz_file(
+                filepath,
+                split_parts=split_parts,
+                extra_data=extra_data,
+            )
+        return
+    convert = partial(
+        convert_moz_file_worker,
+        split_parts=split_parts,
+        extra_data=extra_data,
+    )
+    # Only imported when needed, it's slow.
+    from concurrent.futures import ProcessPoolExecutor
+    jobs = min(jobs, len(filepaths))
+    debug('Converting {} master files with {} workers.'.format(
+        len(filepaths),
+        jobs,
+    ))
+    # Workers share the log file, they inherit this when they are started.
+    os.environ[WORKER_ENV_VAR] = '1'
+    try:
+        with ProcessPoolExecutor(
+                max_workers=jobs,
+                initializer=set_worker_debug_mode,
+                initargs=(get_debug_mode(), )) as pool:
+            for converted, metrics in pool.map(convert, filepaths):
+                run_metrics.merge(metrics)
+                yield from converted
+    finally:
+        os.environ.pop(WORKER_ENV_VAR, None)
+
+
+def get_moz_file_paths(
+        filepaths, ignore_dirs=None, ignore_strs=None, ext='.dat',
+        use_info_cache=True, info_cache=None):
+    """ Resolve files/directories into a list of Mozaik master file paths,
+        in the same order that `load_moz_files` would load them.
+        If `use_info_cache` is truthy, unchanged files found in directories
+        are checked with a DatInfoCache (`info_cache`, or a new one)
+        instead of opening them.
+    """
+    if isinstance(filepaths, str):
+        filepaths = [filepaths]
+    if use_info_cache and (info_cache is None):
+        info_cache = DatInfoCache()
+
+    scanner = DatFileScanner(
+        ignore_dirs=ignore_dirs,
+        ignore_strs=ignore_strs,
+        ext=ext,
+        info_cache=info_cache if use_info_cache else None,
+    )
+    datpaths = []
+    with run_metrics.timer('scan'):
+        for filepath in filepaths:
+            if os.path.isdir(filepath):
+                if scanner.matcher(filepath):
+                    continue
+                # A directory, possibly containing .dat files
+                # or sub-dirs with .dat files.
+                datpaths.extend(get_dir_files(filepath, scanner=scanner))
+            elif filepath.endswith(ext):
+                # A mozaik face-frame.dat file.
+                datpaths.append(filepath)
+            else:
+                raise ValueError(
+                    'Invalid extension for Mozaik CSV file: {}'.format(
+                        filepath,
                     )
                 )
-                return False
-    return True
+        if scanner.info_cache is not None:
+            scanner.info_cache.save()
+    if scanner.dirs:
+        debug(scanner.stats_msg())
+    run_metrics.count('dirs_scanned', scanner.dirs)
+    run_metrics.count('master_files_found', len(datpaths))
+    return datpaths
 
 
 def load_moz_file(filepath, split_parts=True):
     """ Loads a single MozaikMasterFile, and splits it into multiple Mozaik
         width files.
     """
-    master = MozaikMasterFile.from_file(filepath, split_parts=split_parts)
-    debug('Creating width files from: {}'.format(master))
-    return master.into_width_files()
+    debug('Creating width files from: {}'.format(filepath))
+    return MozaikMasterFile.width_files_from_file(
+        filepath,
+        split_parts=split_parts,
+    )
 
 
 def load_moz_files(
@@ -159,78 +363,153 @@ def load_moz_files(
     """ Loads multiple MozaikFiles from file names, and returns a list of
         MozaikFiles.
     """
-    if isinstance(filepaths, str):
-        filepaths = [filepaths]
-
     files = []
-    for filepath in filepaths:
-        if os.path.isdir(filepath):
-            ignore = is_ignored_dir(
-                filepath,
-                ignore_dirs=ignore_dirs,
-                ignore_strs=ignore_strs,
-            )
-            if ignore:
-                continue
-            # A directory, possibly containing .dat files
-            # or sub-dirs with .dat files.
-            files.extend(
-                load_moz_files(
-                    get_dir_files(
-                        filepath,
-                        ignore_dirs=ignore_dirs,
-                        ignore_strs=ignore_strs,
-                        ext=ext,
-                    ),
-                    ignore_dirs=ignore_dirs,
-                    ignore_strs=ignore_strs,
-                    ext=ext,
-                    split_parts=split_parts,
-                )
-            )
-
-        elif filepath.endswith(ext):
-            # A mozaik face-frame.dat file.
-            files.extend(load_moz_file(filepath, split_parts=split_parts))
-        else:
-            raise ValueError(
-                'Invalid extension for Mozaik CSV file: {}'.format(
-                    filepath,
-                )
-            )
+    for filepath in get_moz_file_paths(
+            filepaths,
+            ignore_dirs=ignore_dirs,
+            ignore_strs=ignore_strs,
+            ext=ext):
+        files.extend(load_moz_file(filepath, split_parts=split_parts))
     return files
 
 
+@lru_cache(maxsize=CAB_NO_CACHE_SIZE)
+def parse_cab_no(no):
+    """ Parse a cab `no` string (like: R5:1&2&3 R7:1(2)) into a tuple of
+        (room, cab, multiplier) tuples, one for each cabinet.
+        The `cab` keeps any (n) marker, so split parts keep their original
+        `no`. The `multiplier` is the number inside the parenthesis or 1.
+        A `no` without a room number is in room R1.
+        Results are cached by `no`, because jobs repeat the same cab numbers
+        over and over.
+    """
+    if (no.lower().count('r') > 1) and (' ' in no):
+        roomnos = no.split(' ')
+    else:
+        roomnos = (no, )
+    cabs = []
+    for roomno in roomnos:
+        room, sep, cabnos = roomno.partition(':')
+        if not sep:
+            room, cabnos = 'R1', roomno
+        cabs.extend(
+            (room, cab, get_cab_count(cab))
+            for cab in cabnos.split('&')
+        )
+    return tuple(cabs)
+
+
+def plan_moz_files(filepaths, ignore_dirs=None, ignore_strs=None, ext='.dat'):
+    """ Find the tiger files that would be created from Mozaik master
+        files, and the total part quantity for each one, without parsing,
+        splitting, or combining parts.
+        Master files are only read if their info isn't cached.
+        Returns a list of
+            [(datpath, [(tigerfilename, quantity), ..], error), ..],
+        where `error` is a message for master files that can't be
+        converted, or None.
+    """
+    info_cache = DatInfoCache()
+    datpaths = get_moz_file_paths(
+        filepaths,
+        ignore_dirs=ignore_dirs,
+        ignore_strs=ignore_strs,
+        ext=ext,
+        info_cache=info_cache,
+    )
+    plans = []
+    with run_metrics.timer('parse'):
+        for datpath in datpaths:
+            st = os.stat(datpath)
+            info = info_cache.get(datpath, st, keys=info_cache.info_keys)
+            if info is None:
+                try:
+                    info = get_dat_file_info(datpath)
+                except (csv.Error, ValueError) as ex:
+                    # ValueError includes UnicodeDecodeError.
+                    plans.append((datpath, [], str(ex)))
+                    continue
+                info = info_cache.add(datpath, st, info)
+            run_metrics.count('lines', info['lines'])
+            plans.append((
+                datpath,
+                [
+                    (MozaikFile(datpath, width).filepath, count)
+                    for width, count in sorted(info['counts'].items())
+                ],
+                None,
+            ))
+    info_cache.save()
+    return plans
+
+
+def set_worker_debug_mode(enabled):
+    """ Initializer for worker processes, to match the parent's debug mode.
+    """
+    if enabled:
+        set_debug_mode(True)
+
+
 def strip_words(s, words):
     """ Strip several words from a string. """
     pat = '|'.join('({})'.format(word) for word in words)
     return re.sub(pat, '', s)
 
 
+@lru_cache(maxsize=CAB_NO_CACHE_SIZE)
 def trim_cab_count(cabno):
+    """ Remove any (n) cab count from a `no` string. """
     return re.sub(r'\(\d{1,3}\)', '', cabno)
 
 
 def write_tiger_file(
         mozfile, outdir, archive_dir=None, extra_data=False,
-        error_cb=None, success_cb=None):
+        error_cb=None, success_cb=None, xml=None, name_index=None):
     """ Write a .tiger file from a MozaikFile.
         Without callbacks given, it returns an exit status (0 or 1).
         With callbacks it returns `error_cb(mozfile, msg)` or
-        `success_cb(mozfile, tigerpath)`
-
+        `success_cb(mozfile, tigerpath)`, plus 1 if the tiger file was
+        written but the master file could not be archived.
+        If `xml` is given (from `convert_moz_files()`), it is written
+        instead of rendering it again. Otherwise the XML is streamed into
+        the file as it is rendered.
+        Existing files are never replaced, a (num) is added to the name
+        instead. A FileNameIndex for `outdir` can be given (and shared
+        between calls) to find a free name without checking the file
+        system for each one.
     """
     tigerpath = os.path.join(outdir, mozfile.filepath)
     use_err_cb = callable(error_cb)
     use_success_cb = callable(success_cb)
+    if xml is None:
+        from .format import iter_xml
+        # Rendering happens while writing, but it's timed separately.
+        xmlchunks = run_metrics.timed_iter(
+            'create_xml',
+            iter_xml(mozfile, extra_data=extra_data),
+        )
+    else:
+        xmlchunks = (xml, )
 
-    if os.path.exists(tigerpath):
-        debug_err('Tiger file already exists: {}'.format(tigerpath))
-        tigerpath = increment_file_path(tigerpath)
-        debug_err('Made new tiger file path: {}'.format(tigerpath))
     try:
-        with open(tigerpath, 'w') as f:
-            f.write(create_xml(mozfile, extra_data=extra_data))
+        with run_metrics.timer('write'):
+            newpath, f = open_new_file(tigerpath, name_index=name_index)
+            if newpath != tigerpath:
+                debug_err('Tiger file already exists: {}'.format(tigerpath))
+                tigerpath = newpath
+                debug_err('Made new tiger file path: {}'.format(tigerpath))
+            try:
+                with f:
+                    f.writelines(xmlchunks)
+                    run_metrics.count('bytes_written', f.tell())
+            except BaseException:
+                # Bad data for the XML, a full disk, or Ctrl+C.
+                # Don't leave a partial tiger file.
+                with suppress(OSError):
+                    os.remove(tigerpath)
+                if name_index is not None:
+                    name_index.discard(tigerpath)
+                raise
     except EnvironmentError as ex:
         msg = 'Cannot write tiger file: {}\n{}'.format(
             tigerpath,
@@ -238,6 +517,7 @@ def write_tiger_file(
         )
         print_err(msg)
         return error_cb(mozfile, msg) if use_err_cb else 1
+    run_metrics.count('tiger_files')
     partlen = len(mozfile.parts)
     plural = 'part' if partlen == 1 else 'parts'
     msg = C(' ').join(
@@ -263,7 +543,187 @@ def write_tiger_file(
         created_files=[tigerpath]
     )
     exitstatus = 0 if archived else 1
-    return success_cb(mozfile, tigerpath) if use_success_cb else exitstatus
+    if use_success_cb:
+        return success_cb(mozfile, tigerpath) + exitstatus
+    return exitstatus
+
+
+class DatFileScanner(object):
+    """ Finds Mozaik (.dat) files in directories with `os.scandir()`, using
+        the file type info from the directory listing instead of stat()ing
+        every entry. Ignored directories are skipped before descending.
+        With a DatInfoCache, files that haven't changed since they were
+        last checked are not opened again.
+        Counts are kept for everything that is touched, because every
+        listing/stat/open is a round trip on network shares.
+    """
+    def __init__(
+            self, ignore_dirs=None, ignore_strs=None, ext='.dat',
+            info_cache=None):
+        self.matcher = IgnoreMatcher(
+            ignore_dirs=ignore_dirs,
+            ignore_strs=ignore_strs,
+        )
+        self.ext = ext
+        self.info_cache = info_cache
+        # Directories listed.
+        self.dirs = 0
+        # Directory entries seen.
+        self.entries = 0
+        # Entries that needed a stat() to find their type (symlinks), or
+        # to check the info cache (free on Windows).
+        self.stats = 0
+        # Files with cached info, that didn't need to be opened.
+        self.cached = 0
+        # Files opened to check their column count.
+        self.opened = 0
+
+    def __repr__(self):
+        return '{}(matcher={!r}, ext={!r})'.format(
+            type(self).__name__,
+            self.matcher,
+            self.ext,
+        )
+
+    def is_valid_file(self, entry, _indent=''):
+        """ Returns True if a DirEntry is a valid Mozaik file, using the
+            info cache if possible.
+            Only the first line is read, files that can't be read are
+            not valid.
+        """
+        if self.info_cache is None:
+            self.opened += 1
+            return is_valid_dat_file(entry.path, _indent=_indent)
+        try:
+            st = entry.stat()
+        except OSError as ex:
+            debug_err('{}Unable to stat: {}\n{}'.format(
+                _indent,
+                entry.path,
+                ex,
+            ))
+            return False
+        if os.name != 'nt':
+            self.stats += 1
+        info = self.info_cache.get(entry.path, st)
+        if info is None:
+            self.opened += 1
+            try:
+                columns = get_dat_file_columns(entry.path)
+            except (csv.Error, OSError, ValueError) as ex:
+                # ValueError includes UnicodeDecodeError, for binary files.
+                debug_err('{}Unable to read: {}\n{}'.format(
+                    _indent,
+                    entry.path,
+                    ex,
+                ))
+                return False
+            info = self.info_cache.add(entry.path, st, {'columns': columns})
+        else:
+            self.cached += 1
+        return is_valid_column_count(
+            info['columns'],
+            entry.path,
+            _indent=_indent,
+        )
+
+    def scan(self, dirpath, _level=0):
+        """ Returns valid Mozaik file paths in a directory, and it's
+            sub-directories.
+        """
+        indent = '  ' * _level
+        debug('{}Looking for {} files in: {}'.format(
+            indent,
+            self.ext,
+            dirpath
+        ))
+        with os.scandir(dirpath) as entries:
+            entries = list(entries)
+        self.dirs += 1
+        self.entries += len(entries)
+        datfiles = []
+        for entry in entries:
+            if self.matcher(entry.path):
+                continue
+            if entry.is_symlink():
+                # is_dir() has to follow the link.
+                self.stats += 1
+            try:
+                is_dir = entry.is_dir()
+            except OSError as ex:
+                debug_err('{}Unable to check: {}\n{}'.format(
+                    indent,
+                    entry.path,
+                    ex,
+                ))
+                continue
+            if is_dir:
+                datfiles.extend(self.scan(entry.path, _level=_level + 1))
+            elif entry.name.endswith(self.ext):
+                if self.is_valid_file(entry, _indent=indent):
+                    debug('{}Found {} file: {}'.format(
+                        indent,
+                        self.ext,
+                        entry.path,
+                    ))
+                    datfiles.append(entry.path)
+        return datfiles
+
+    def stats_msg(self):
+        """ Returns a message with the counts for everything touched. """
+        return (
+            'Scanned {s.dirs} dirs, {s.entries} entries '
+            '({s.stats} stats, {s.opened} files opened, {s.cached} cached).'
+        ).format(s=self)
+
+
+class IgnoreMatcher(object):
+    """ Matches paths against `ignore_dirs` and `ignore_strs`, which are
+        prepared once instead of for every path.
+        A path is ignored if it contains any of the `ignore_strs`
+        (case-insensitive), or starts with any of the `ignore_dirs`.
+    """
+    def __init__(self, ignore_dirs=None, ignore_strs=None):
+        self.ignore_dirs = tuple(sorted(set(ignore_dirs or ())))
+        self.dir_set = frozenset(self.ignore_dirs)
+        self.ignore_strs = tuple(
+            sorted(set(s.lower() for s in (ignore_strs or ())))
+        )
+        self.str_pat = None
+        if self.ignore_strs:
+            self.str_pat = re.compile(
+                '|'.join(re.escape(s) for s in self.ignore_strs)
+            )
+
+    def __bool__(self):
+        return bool(self.ignore_dirs or self.ignore_strs)
+
+    def __call__(self, dirpath):
+        """ Return True if this `dirpath` should be ignored. """
+        if self.str_pat is not None:
+            match = self.str_pat.search(dirpath.lower())
+            if match is not None:
+                debug('Ignoring matched string ({!r}): {}'.format(
+                    match.group(),
+                    dirpath,
+                ))
+                return True
+        if not self.ignore_dirs:
+            return False
+        if dirpath.rstrip('/') in self.dir_set:
+            debug('Ignoring matched dir: {}'.format(dirpath))
+            return True
+        if dirpath.startswith(self.ignore_dirs):
+            debug('Ignoring partial-match dir: {}'.format(dirpath))
+            return True
+        return False
+
+    def __repr__(self):
+        return '{}(ignore_dirs={!r}, ignore_strs={!r})'.format(
+            type(self).__name__,
+            self.ignore_dirs,
+            self.ignore_strs,
+        )
 
 
 class MozaikMasterFile(object):
@@ -339,11 +799,14 @@ class MozaikMasterFile(object):
         """
         debug('Parsing: {}'.format(filepath))
         self.filepath = filepath
-        with open(filepath) as f:
+        lines = 0
+        with run_metrics.timer('parse'), open(filepath) as f:
             for row in csv.reader(f):
                 parts = self.parse_row(row, split_parts=split_parts)
                 self.count += sum(p.count for p in parts)
                 self.parts.extend(parts)
+                lines += 1
+        run_metrics.count('lines', lines)
         debug('Parsed into: {}'.format(self))
         return self
 
@@ -377,34 +840,97 @@ class MozaikMasterFile(object):
         """ Split this MozaikMasterFile into seperate MozaikFiles, each
             with their own width.
         """
-        if not self.parts:
+        return self.width_files_from_parts(
+            self.parts,
+            filepath=self.filepath,
+            count=self.count,
+        )
+
+    @classmethod
+    def iter_file_parts(cls, filepath, split_parts=True):
+        """ Parse a Mozaik CSV (.dat) file one row at a time, yielding
+            MozaikMasterParts without storing them.
+        """
+        debug('Streaming parts from: {}'.format(filepath))
+        lines = 0
+        with open(filepath) as f:
+            for row in csv.reader(f):
+                yield from cls.parse_row(row, split_parts=split_parts)
+                lines += 1
+        run_metrics.count('lines', lines)
+
+    @classmethod
+    def width_files_from_file(cls, filepath, split_parts=True):
+        """ Create MozaikFiles (one per width) directly from a Mozaik CSV
+            (.dat) file, without building a MozaikMasterFile.
+            Memory depends on the number of distinct parts, not the number
+            of lines in the file.
+        """
+        return cls.width_files_from_parts(
+            run_metrics.timed_iter(
+                'parse',
+                cls.iter_file_parts(filepath, split_parts=split_parts),
+            ),
+            filepath=filepath,
+        )
+
+    @staticmethod
+    def width_files_from_parts(parts, filepath=None, count=None):
+        """ Aggregate an iterable of MozaikMasterParts into MozaikFiles, one
+            for each width, with similar parts combined.
+            Parts are only used while they are being counted, so `parts`
+            can be a generator.
+            Arguments:
+                parts     : An iterable of MozaikMasterParts.
+                filepath  : Master file path, for the width file names.
+                count     : Expected part count, for debugging. If not given,
+                            the count of parts from `parts` is used.
+        """
+        # Parts are keyed by width, and then by
+        # (room, cab, length, extra_data, type) in a tree for each width.
+        labels = MozaikPart.tree_labels
+        trees = {}
+        partcount = 0
+        partlen = 0
+        with run_metrics.timer('width_files'):
+            for part in parts:
+                partcount += part.count
+                partlen += 1
+                tree = trees.get(part.width, None)
+                if tree is None:
+                    # New width file.
+                    tree = trees[part.width] = MozaikPartTree(
+                        {},
+                        label='room',
+                    )
+                part.add_to_tree(tree, labels=labels)
+        run_metrics.count('parts', partlen)
+        if not trees:
             return []
-        filedata = {}
-        for part in self.parts:
-            newpart = MozaikPart({
-                field: getattr(part, field) for field in MozaikFile.header
-            })
-            if filedata.get(part.width, None) is None:
-                # New width file.
-                filedata[part.width] = MozaikFile(self.filepath, part.width)
-            # Append part to this width file.
-            filedata[part.width].parts.append(newpart)
-            filedata[part.width].count += newpart.count
-
-        mozfiles = [filedata[width] for width in sorted(filedata)]
-        for mozfile in mozfiles:
-            mozfile.parent_file = self.filepath
-            mozfile.combine_parts()
 
+        mozfiles = []
+        with run_metrics.timer('combine_parts'):
+            for width in sorted(trees):
+                mozfile = MozaikFile(filepath, width)
+                mozfile.parent_file = filepath
+                mozfile.parts = MozaikPartTree(
+                    {width: trees[width]},
+                    label='width',
+                ).to_mozaikparts()
+                mozfile.count = sum(p.count for p in mozfile.parts)
+                mozfiles.append(mozfile)
+        run_metrics.count('width_files', len(mozfiles))
+
+        mastercount = partcount if count is None else count
         mozfilecount = sum(mozfile.count for mozfile in mozfiles)
-        if self.count == mozfilecount:
+        if mastercount == mozfilecount:
             debug('Part count is same: Master={}, MozFiles={}'.format(
-                self.count,
+                mastercount,
                 mozfilecount,
             ))
         else:
             debug_err('Part count is off: Master={}, MozFiles={}'.format(
-                self.count,
+                mastercount,
                 mozfilecount,
             ))
 
@@ -418,8 +944,7 @@ class MozaikMasterFile(object):
         """ Return a tree/dict of parts for this master file. """
         tree = MozaikPartTree({}, label='room', filepath=self.filepath)
         for part in self.parts:
-            parttree = part.tree()
-            tree.update(parttree)
+            part.add_to_tree(tree)
 
         return tree
 
@@ -478,8 +1003,9 @@ class MozaikFile(object):
         # and combine them into: 3,5,TR,R1:1(3)
         debug('Combining parts in: {}'.format(self))
         length = len(self)
-        tree = self.tree()
-        self.parts = tree.to_mozaikparts()
+        with run_metrics.timer('combine_parts'):
+            tree = self.tree()
+            self.parts = tree.to_mozaikparts()
         debug('Parts combined: {}'.format(length - len(self)), align=True)
 
     def fix_filepath(self, filepath, width):
@@ -534,8 +1060,7 @@ class MozaikFile(object):
         """ Return a tree/dict of parts for this file. """
         tree = MozaikPartTree({}, label='room')
         for part in self.parts:
-            parttree = part.tree()
-            tree.update(parttree)
+            part.add_to_tree(tree)
 
         return MozaikPartTree(
             {self.width: tree},
@@ -547,6 +1072,9 @@ class MozaikFile(object):
 class MozaikMasterPart(object):
     """ Holds info about a single part to be cut. """
     header = MozaikMasterFile.header
+    # Labels for each level of a MozaikPartTree built from these parts.
+    # The first label belongs to the root tree.
+    tree_labels = ('room', 'cab', 'width', 'length', 'extra_data', 'type')
 
     # Corrections/replacements for certain values (for certain attributes).
     value_map = {
@@ -555,30 +1083,14 @@ class MozaikMasterPart(object):
         },
     }
 
-    def __init__(self, data):
-        # Set attributes based on the header.
-        for field in self.header:
-            setattr(self, field, None)
+    __slots__ = MozaikMasterFile.header
 
+    def __init__(self, data):
         try:
             # Dict of {field: value}?
-            for k, v in data.items():
-                if k not in self.header:
-                    raise ValueError(
-                        'Initialized with unknown header: {!r}={!r}'.format(
-                            k,
-                            v,
-                        )
-                    )
-                replacements = self.value_map.get(k, None)
-                if replacements:
-                    val = self.value_map[k].get(v, v)
-                else:
-                    val = v
-                with suppress(AttributeError):
-                    val = val.strip()
-                setattr(self, k, val)
-        except AttributeError as ex:
+            unknown = [k for k in data if k not in self.header]
+            get = data.get
+        except (AttributeError, TypeError) as ex:
             debug_err('Not a dict: {} ({})'.format(
                 type(data).__name__,
                 ex,
@@ -586,6 +1098,22 @@ class MozaikMasterPart(object):
             raise TypeError('Expected dict, got: {}'.format(
                 type(data).__name__,
             ))
+        if unknown:
+            raise ValueError(
+                'Initialized with unknown header: {!r}={!r}'.format(
+                    unknown[0],
+                    data[unknown[0]],
+                )
+            )
+        # Set attributes based on the header.
+        for field in self.header:
+            val = get(field, None)
+            replacements = self.value_map.get(field, None)
+            if replacements:
+                val = replacements.get(val, val)
+            if isinstance(val, str):
+                val = val.strip()
+            setattr(self, field, val)
         try:
             self.count = int(self.count)
         except (TypeError, ValueError):
@@ -603,10 +1131,12 @@ class MozaikMasterPart(object):
         return any(getattr(self, k, None) for k in self.header)
 
     def __eq__(self, other):
-        return str(self) == str(other)
+        if type(other) is not type(self):
+            return False
+        return self.fields() == other.fields()
 
     def __hash__(self):
-        return hash(str(self))
+        return hash(self.fields())
 
     def __repr__(self):
         """ String representation of this MozaikMasterPart. """
@@ -625,11 +1155,23 @@ class MozaikMasterPart(object):
 
     def copy(self):
         """ Return a copy of this instance. """
-        data = {
-            field: getattr(self, field)
-            for field in self.header
-        }
-        return self.__class__(data)
+        return self.replace()
+
+    def fields(self):
+        """ Return a tuple of this part's values, in `self.header` order.
+        """
+        return tuple(getattr(self, field, None) for field in self.header)
+
+    def replace(self, **kwargs):
+        """ Return a copy of this instance, with some fields replaced.
+            Values are used as-is. They are not cleaned up or checked like
+            they are in `__init__()`.
+        """
+        cls = type(self)
+        part = cls.__new__(cls)
+        for field in self.header:
+            setattr(part, field, kwargs.get(field, getattr(self, field)))
+        return part
 
     def find_similar(self, parts):
         """ Yield all similar parts to this one from the `parts` list. """
@@ -659,52 +1201,16 @@ class MozaikMasterPart(object):
         # ...but it still may count the parts wrong:
         #   2,<width>,<length>,<type>,R1:1 R2:2(2),<extra>
         # This next bit of code fixes that when needed.
-        self.count = sum(
-            self.get_cab_count(cab)
-            for room in self.no.split(' ')
-            for cab in room.split('&')
-        )
+        self.count = sum(count for _, _, count in parse_cab_no(self.no))
         return self.count
 
-    @staticmethod
-    def get_cab_count(cabno, multi_allowed=False):
-        """ Parse out multiple cab counts from a `no` string (like: R1:1(2)).
-            Returns the number inside the parenthesis or 1.
-        """
-        allcounts = cab_multi_count_pat.findall(cabno)
-        if allcounts:
-            cabcount = sum(int(s) for s in allcounts)
-            debug(
-                'Found multi {}: {} in {!r}'.format(
-                    'count' if len(allcounts) == 1 else 'counts',
-                    cabcount,
-                    cabno,
-                )
-            )
-            return cabcount
-
-        if ('(' in cabno):
-            if ((' ' in cabno) or ('&' in cabno)) and multi_allowed:
-                debug('Missed cab count for multi-room: {!r}'.format(cabno))
-            else:
-                debug_err(
-                    'Missed cab count?: {!r}'.format(cabno),
-                    file=sys.stderr,
-                )
-                debug_err(
-                    '<-- get_cab_count() called from.',
-                    level=1,
-                    file=sys.stderr,
-                )
-        return 1
-
     def has_multi(self):
         """ Return True if this MozaikPart has multiple cabs or rooms in
             the cab no.
         """
         if not self.no:
             return False
-        return self.has_multi_cab() or self.has_multi_room()
+        return len(parse_cab_no(self.no)) > 1
 
     def has_multi_cab(self):
         """ Return True if this MozaikPart has multiple cabs in the cab no.
@@ -716,6 +1222,13 @@ class MozaikMasterPart(object):
         """
         return (self.no.lower().count('r') > 1) and (' ' in self.no)
 
+    def room_cab(self):
+        """ Return a tuple of (room, cab) for a single room/cab part,
+            without any (n) cab count.
+        """
+        (room, cab, _), *_ = parse_cab_no(self.no)
+        return room, trim_cab_count(cab)
+
     def similar_part(self, other):
         """ Returns True if `other` is the same exact part as this,
             except for the count.
@@ -734,8 +1247,8 @@ class MozaikMasterPart(object):
                 if getattr(self, field) != getattr(other, field):
                     return False
         debug('Same part:')
-        debug(str(self), align=True)
-        debug(str(other), align=True)
+        debug(self, align=True)
+        debug(other, align=True)
         return True
 
     def split_parts(self):
@@ -744,98 +1257,21 @@ class MozaikMasterPart(object):
             Otherwise returns a list with [self].
         """
         if not self.has_multi():
-            debug('Single part: {}'.format(self))
+            debug(LazyMsg('Single part: {}', self))
             return [self]
 
-        # Split rooms.
-        roomparts = self.split_rooms()
-        # Split cabs.
-        return self.split_room_cabs(roomparts)
-
-    def split_room_cabs(self, roomparts):
-        """ Split each single-room part, with possibly multiple parts on one
-            line, into separate parts for each cabinet number.
-            Returns a list of parts, possible just [self] for single room and
-            single cab parts.
-
-            Raises ValueError if a multi-room part is encountered.
-            Arguments:
-                roomparts  : A list of MozaikParts with only a single-room
-                             number for each part.
-        """
-        cabparts = []
-        multiroom = []
-        for roompart in roomparts:
-            if roompart.has_multi_room():
-                multiroom.append(roompart)
-                debug_err('Got multi-room part: {}'.format(roompart))
-                continue
-            if ':' not in roompart.no:
-                debug_err('No room number: {}'.format(roompart))
-                roompart.no = 'R1:{}'.format(roompart.no)
-            roomno, sep, cabs = roompart.no.partition(':')
-
-            cabnos = cabs.split('&')
-            if len(cabnos) == 1:
-                roompart.count = self.get_cab_count(roompart.no)
-                cabparts.append(roompart)
-                debug('Added single cab part: {}'.format(roompart))
-                continue
-            # Parse multiple cab nos.
-            debug('Multiple cabs: {}'.format(cabs))
-            for cab in cabs.split('&'):
-                debug('Parsing cab part: {!r}'.format(cab))
-                part = roompart.copy()
-                part.no = ':'.join((roomno, cab))
-                part.count = self.get_cab_count(cab)
-                cabparts.append(part)
-                debug(
-                    'Added separate cab part: {}'.format(part),
-                    align=True,
-                )
-        if multiroom:
-            debug_err('Handling mistaken multi-room parts:')
-            deferredroomparts = []
-            for part in multiroom:
-                deferredroomparts.extend(part.split_rooms())
-            deferredcabparts = self.split_room_cabs(deferredroomparts)
-            debug_err('Re-split cabs ({}) for {} multi-room parts.'.format(
-                len(deferredcabparts),
-                len(deferredroomparts),
-            ))
-            cabparts.extend(deferredcabparts)
-        return cabparts
-
-    def split_rooms(self):
-        """ Split this part, with possibly multiple rooms, into separate
-            parts for each room number.
-            See also: self.split_parts and self.split_room_cabs
-            Returns a list of parts, possibly just [self] for single rooms.
-        """
-        if not self.has_multi_room():
-            return [self]
-
-        originalcnt = self.count
-        roomparts = []
-        roomnos = self.no.split(' ')
-        if len(roomnos) == 1:
-            part = self.copy()
-            roomparts.append(part)
-            debug('Added single room part: {}'.format(part))
-        else:
-            debug('Multiple rooms: {}'.format(self.no))
-            for roomno in roomnos:
-                part = self.copy()
-                part.no = roomno
-                part.count = roomno.count('&') + self.get_cab_count(roomno)
-                roomparts.append(part)
-                debug('Added separate room part: {}'.format(part), align=True)
-            roomsplitcnt = sum(p.count for p in roomparts)
-            if roomsplitcnt != originalcnt:
-                debug_err('Splitting rooms changed count:', align=True)
-                debug_err('Original: {}'.format(originalcnt), align=True)
-                debug_err('   Split: {}'.format(roomsplitcnt), align=True)
-        return roomparts
+        cabs = parse_cab_no(self.no)
+        debug(LazyMsg('Splitting {} cabs: {}', len(cabs), self.no))
+        parts = [
+            self.replace(no=':'.join((room, cab)), count=count)
+            for room, cab, count in cabs
+        ]
+        splitcnt = sum(p.count for p in parts)
+        if splitcnt != self.count:
+            debug_err('Splitting cabs changed count:', align=True)
+            debug_err('Original: {}'.format(self.count), align=True)
+            debug_err('   Split: {}'.format(splitcnt), align=True)
+        return parts
 
     def to_csv(self):
         """ Convert back into a csv line. """
@@ -847,12 +1283,12 @@ class MozaikMasterPart(object):
     def tree(self):
         """ Return this mozaik master part in tree-style:
                 {
-                    width: {
-                        room: {
-                            cab_no: {
-                                part_type: {
+                    room: {
+                        cab_no: {
+                            width: {
+                                length: {
                                     extra_data: {
-                                        length: count
+                                        part_type: count
                                     }
                                 }
                             }
@@ -860,99 +1296,56 @@ class MozaikMasterPart(object):
                     }
                 }
         """
-        tree = {}
+        return self.add_to_tree(MozaikPartTree({}, label='room'))
+
+    def add_to_tree(self, tree, labels=None):
+        """ Add this part (split into single room/cab parts) to an existing
+            MozaikPartTree, in place. Each part costs O(depth), instead of
+            re-merging the whole tree like `MozaikPartTree.update()`.
+            Returns the `tree` that was passed in.
+            Arguments:
+                tree    : The MozaikPartTree to add to.
+                labels  : Tree labels to use, if not `self.tree_labels`.
+        """
+        labels = labels or self.tree_labels
         for part in self.split_parts():
-            # room, cab, width, length, extra, part
-            try:
-                room, cab = part.no.split(':')
-            except ValueError:
-                # No room number.
-                room = 'R1'
-                cab = part.no
-            cab = trim_cab_count(cab)
-            tree.setdefault(
-                room,
-                MozaikPartTree({}, label='cab')
-            )
-            tree[room].setdefault(
-                cab,
-                MozaikPartTree({}, label='width')
-            )
-            tree[room][cab].setdefault(
-                part.width,
-                MozaikPartTree({}, label='length')
-            )
-            w = part.width
-            tree[room][cab][w].setdefault(
-                part.length,
-                MozaikPartTree({}, label='extra_data')
-            )
-            tree[room][cab][w][part.length].setdefault(
-                part.extra_data,
-                MozaikPartTree({}, label='type')
-            )
-            tree[room][cab][w][part.length][part.extra_data].setdefault(
-                part.type,
-                0
-            )
-            tree[room][cab][w][part.length][part.extra_data][part.type] += (
-                part.count
-            )
+            tree.add_leaf(part.tree_keys(labels), labels, part.count)
+        return tree
 
-        return MozaikPartTree(tree, label='room')
+    def tree_keys(self, labels=None):
+        """ Return the keys needed to find this part's count in a
+            MozaikPartTree, in the order of `labels` (or `self.tree_labels`).
+            The first two labels are always 'room' and 'cab'.
+        """
+        room, cab = self.room_cab()
+        return (room, cab) + tuple(
+            getattr(self, label)
+            for label in (labels or self.tree_labels)[2:]
+        )
 
 
 class MozaikPart(MozaikMasterPart):
     """ A part with a width that depends on the MozaikFile's width. """
     header = MozaikFile.header
-
-    def __init__(self, data):
-        super().__init__(data)
+    tree_labels = ('room', 'cab', 'length', 'extra_data', 'type')
+    # The 'width' slot from MozaikMasterPart is never set for these.
+    __slots__ = ()
 
     def tree(self):
         """ Return this mozaik part in tree-style:
                 {
                     room: {
                         cab_no: {
-                            part_type: {
+                            length: {
                                 extra_data: {
-                                    length: count
+                                    part_type: count
                                 }
                             }
                         }
                     }
                 }
         """
-        tree = {}
-        for part in self.split_parts():
-            # room, cab, width, length, extra, part
-            room, cab = part.no.split(':')
-            cab = trim_cab_count(cab)
-            tree.setdefault(
-                room,
-                MozaikPartTree({}, label='cab')
-            )
-            tree[room].setdefault(
-                cab,
-                MozaikPartTree({}, label='length')
-            )
-            tree[room][cab].setdefault(
-                part.length,
-                MozaikPartTree({}, label='extra_data')
-            )
-            tree[room][cab][part.length].setdefault(
-                part.extra_data,
-                MozaikPartTree({}, label='type')
-            )
-            tree[room][cab][part.length][part.extra_data].setdefault(
-                part.type,
-                0
-            )
-            tree[room][cab][part.length][part.extra_data][part.type] += (
-                part.count
-            )
-
-        return MozaikPartTree(tree, label='room')
+        return self.add_to_tree(MozaikPartTree({}, label='room'))
 
 
 class MozaikPartTree(UserDict):
@@ -990,6 +1383,28 @@ class MozaikPartTree(UserDict):
     def __str__(self):
         return repr(self)
 
+    def add_leaf(self, keys, labels, count):
+        """ Add `count` to the leaf at the end of `keys`, creating any
+            missing branches along the way.
+            This mutates the tree in place, in O(len(keys)).
+            Arguments:
+                keys    : Keys for each level of the tree, starting with
+                          this tree's keys.
+                labels  : Labels for each level of the tree, starting with
+                          this tree's label.
+                count   : Number to add to the leaf's count.
+        """
+        node = self
+        # Branches are labeled by the level below them.
+        for key, label in zip(keys[:-1], labels[1:]):
+            branch = node.data.get(key, None)
+            if branch is None:
+                branch = node.data[key] = type(self)({}, label=label)
+            node = branch
+        leafkey = keys[-1]
+        node.data[leafkey] = node.data.get(leafkey, 0) + count
+        return node
+
     @classmethod
     def color_args(cls, index):
         return cls.level_colors[index % cls.level_colors_len]
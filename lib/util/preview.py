@@ -13,8 +13,13 @@ from colr import Colr as C
 from .format import TigerFile
 from .parser import MozaikMasterFile
 
+# Largest Mozaik file (in bytes) to preview without asking.
+# Previews are built directly from the parts (no XML), so this can be
+# fairly large. About 15k lines, which takes around a second.
+PREVIEW_MAX_SIZE = 500000
 
-def check_file(filepath, max_size=16000):
+
+def check_file(filepath, max_size=PREVIEW_MAX_SIZE):
     """ Check if a file exists, and is not larger than `max_size` bytes.
         Raises FileNotFoundError if the file cannot be found.
         Raises LargeFileError if the file is over `max_size` bytes.
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+
+""" tigertamer - lib/util/profiler.py
+    CPU (cProfile) and memory (tracemalloc) profiling for --profile.
+    Reports are saved next to tigertamer.log.
+    -Christopher Welborn 10-16-2026
+"""
+
+import cProfile
+import io
+import os
+import pstats
+import tracemalloc
+from contextlib import contextmanager
+
+from .config import SCRIPTDIR
+from .logger import (
+    debug,
+    print_err,
+    status,
+)
+
+# Raw cProfile stats, for `python -m pstats` or other viewers.
+PROFILE_STATSFILE = os.path.join(SCRIPTDIR, 'tigertamer_profile.pstats')
+# Text summaries of the CPU and memory profiles.
+PROFILE_CPUFILE = os.path.join(SCRIPTDIR, 'tigertamer_profile.txt')
+PROFILE_MEMFILE = os.path.join(SCRIPTDIR, 'tigertamer_memory.txt')
+# Number of functions/lines to show in the text summaries.
+PROFILE_TOP = 40
+# Profile types for --profile, and which profilers they use (cpu, mem).
+PROFILE_TYPES = {
+    'all': (True, True),
+    'cpu': (True, False),
+    'mem': (False, True),
+}
+# Number of stack frames to keep for each tracemalloc allocation.
+TRACEMALLOC_FRAMES = 1
+
+
+@contextmanager
+def profiled(kind='cpu', top=PROFILE_TOP):
+    """ Profile a block of code, and write the reports when it's done,
+        even if it raised an error.
+        `kind` is one of `PROFILE_TYPES`.
+    """
+    try:
+        use_cpu, use_mem = PROFILE_TYPES[kind]
+    except KeyError:
+        raise ValueError('Invalid profile type: {!r} (use: {})'.format(
+            kind,
+            ', '.join(sorted(PROFILE_TYPES)),
+        ))
+    profiler = cProfile.Profile() if use_cpu else None
+    if use_mem:
+        tracemalloc.start(TRACEMALLOC_FRAMES)
+        debug('Started tracemalloc.')
+    if profiler is not None:
+        profiler.enable()
+        debug('Started cProfile.')
+    try:
+        yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            write_cpu_report(profiler, top=top)
+        if use_mem:
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            write_mem_report(snapshot, current, peak, top=top)
+
+
+def write_cpu_report(profiler, top=PROFILE_TOP):
+    """ Save raw stats from a cProfile.Profile, and a summary of the `top`
+        functions by cumulative and internal time.
+    """
+    try:
+        profiler.dump_stats(PROFILE_STATSFILE)
+    except EnvironmentError as ex:
+        print_err('Unable to save profile stats: {}\n{}'.format(
+            PROFILE_STATSFILE,
+            ex,
+        ))
+    else:
+        status('Saved profile stats', PROFILE_STATSFILE)
+    report = io.StringIO()
+    stats = pstats.Stats(profiler, stream=report)
+    stats.strip_dirs()
+    for sortkey in ('cumulative', 'tottime'):
+        print('Top {} functions by {}:'.format(top, sortkey), file=report)
+        stats.sort_stats(sortkey).print_stats(top)
+    return write_report(PROFILE_CPUFILE, report.getvalue(), 'CPU profile')
+
+
+def write_mem_report(snapshot, current, peak, top=PROFILE_TOP):
+    """ Save a summary of the `top` lines that allocated the most memory,
+        from a tracemalloc.Snapshot.
+    """
+    snapshot = snapshot.filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+        tracemalloc.Filter(False, '<unknown>'),
+    ))
+    lines = [
+        'Current memory: {:0.1f} KiB'.format(current / 1024),
+        'Peak memory:    {:0.1f} KiB'.format(peak / 1024),
+        '',
+        'Top {} lines by memory still allocated:'.format(top),
+    ]
+    for i, stat in enumerate(snapshot.statistics('lineno')[:top], start=1):
+        frame = stat.traceback[0]
+        lines.append('{:>3}. {:>10.1f} KiB {:>8} blocks  {}:{}'.format(
+            i,
+            stat.size / 1024,
+            stat.count,
+            frame.filename,
+            frame.lineno,
+        ))
+    lines.append('')
+    return write_report(PROFILE_MEMFILE, '\n'.join(lines), 'Memory profile')
+
+
+def write_report(filepath, content, name):
+    """ Write a text report, and let the user know where it is.
+        Returns True on success.
+    """
+    try:
+        with open(filepath, 'w') as f:
+            f.write(content)
+    except EnvironmentError as ex:
+        print_err('Unable to save {}: {}\n{}'.format(name, filepath, ex))
+        return False
+    status('Saved {}'.format(name), filepath)
+    return True
@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+
+""" tigertamer - lib/util/watcher.py
+    Watches directories for new Mozaik (.dat) files, for --watch.
+    -Christopher Welborn 10-16-2026
+"""
+
+import csv
+import os
+from time import monotonic, sleep
+
+from .logger import (
+    debug,
+    debug_err,
+)
+from .parser import (
+    IgnoreMatcher,
+    is_valid_dat_file,
+)
+
+try:
+    # Optional, for instant wake-ups on Linux.
+    from inotify_simple import (
+        flags as inotify_flags,
+        INotify,
+    )
+except ImportError:
+    INotify = None
+
+# Seconds between scans when polling.
+POLL_INTERVAL = 0.5
+# Seconds that a file's size/mtime must stay the same before it's converted.
+SETTLE_TIME = 1.0
+# Seconds between scans with inotify, when nothing has changed.
+# Changes on network shares are not always reported by inotify.
+INOTIFY_RESCAN = 10
+
+
+class DatWatcher(object):
+    """ Watches files/directories for new or changed Mozaik (.dat) files.
+        A file is ready once it's size and mtime haven't changed for
+        `settle` seconds, so files that Mozaik is still writing are
+        skipped until they are complete.
+        With `inotify_simple` installed, inotify is used to wake up as soon
+        as something changes. Otherwise the paths are scanned every
+        `interval` seconds.
+    """
+    def __init__(
+            self, paths, ignore_dirs=None, ignore_strs=None, ext='.dat',
+            interval=POLL_INTERVAL, settle=SETTLE_TIME):
+        if isinstance(paths, str):
+            paths = [paths]
+        self.paths = list(paths)
+        self.matcher = IgnoreMatcher(
+            ignore_dirs=ignore_dirs,
+            ignore_strs=ignore_strs,
+        )
+        self.ext = ext
+        self.interval = interval
+        self.settle = settle
+        # Files that were already handled, {filepath: (size, mtime_ns)}.
+        self.seen = {}
+        # Files that may still be changing,
+        # {filepath: ((size, mtime_ns), time_first_seen)}.
+        self.pending = {}
+        # inotify watch descriptors, {wd: dirpath}.
+        self.watched_dirs = {}
+        self.inotify = None
+        if INotify is not None:
+            try:
+                self.inotify = INotify()
+            except OSError as ex:
+                debug_err('Unable to use inotify, polling instead: {}'.format(
+                    ex,
+                ))
+        debug('Watching with {}: {}'.format(
+            'polling' if self.inotify is None else 'inotify',
+            ', '.join(self.paths),
+        ))
+
+    def __repr__(self):
+        return '{}(paths={!r}, interval={!r}, settle={!r})'.format(
+            type(self).__name__,
+            self.paths,
+            self.interval,
+            self.settle,
+        )
+
+    def iter_dir_files(self, dirpath):
+        """ Yield (filepath, os.stat_result) for files in a directory and
+            it's sub-directories.
+        """
+        self.watch_dir(dirpath)
+        try:
+            entries = list(os.scandir(dirpath))
+        except OSError as ex:
+            debug_err('Unable to list directory: {}\n{}'.format(dirpath, ex))
+            return
+        for entry in entries:
+            if self.matcher(entry.path):
+                continue
+            try:
+                if entry.is_dir():
+                    yield from self.iter_dir_files(entry.path)
+                elif entry.name.endswith(self.ext):
+                    yield entry.path, entry.stat()
+            except OSError:
+                # Removed while scanning.
+                continue
+
+    def iter_files(self):
+        """ Yield (filepath, os.stat_result) for all files in `self.paths`
+            that have the right extension.
+        """
+        for path in self.paths:
+            if os.path.isdir(path):
+                yield from self.iter_dir_files(path)
+            elif path.endswith(self.ext):
+                try:
+                    yield path, os.stat(path)
+                except FileNotFoundError:
+                    continue
+
+    def ready_files(self):
+        """ Scan for files, and return a list of new or changed files that
+            are done being written.
+        """
+        now = monotonic()
+        found = {
+            filepath: (st.st_size, st.st_mtime_ns)
+            for filepath, st in self.iter_files()
+        }
+        # Forget files that were removed (like when they are archived).
+        for filepath in set(self.seen).difference(found):
+            self.seen.pop(filepath)
+        for filepath in set(self.pending).difference(found):
+            self.pending.pop(filepath)
+
+        ready = []
+        for filepath, sig in sorted(found.items()):
+            if self.seen.get(filepath, None) == sig:
+                continue
+            pendingsig, since = self.pending.get(filepath, (None, now))
+            if pendingsig != sig:
+                # New file, or it's still being written.
+                self.pending[filepath] = (sig, now)
+                continue
+            if (now - since) < self.settle:
+                continue
+            self.pending.pop(filepath)
+            self.seen[filepath] = sig
+            try:
+                valid = is_valid_dat_file(filepath)
+            except (csv.Error, OSError, UnicodeDecodeError) as ex:
+                # It's already marked as seen, so it's not checked again
+                # until it changes.
+                debug_err('Unable to check file: {}\n{}'.format(filepath, ex))
+                valid = False
+            if valid:
+                debug('File is ready: {}'.format(filepath))
+                ready.append(filepath)
+        return ready
+
+    def wait(self):
+        """ Wait until something may have changed, or until pending files
+            may be done.
+        """
+        timeout = None
+        if self.pending:
+            now = monotonic()
+            timeout = min(
+                since + self.settle - now
+                for _, since in self.pending.values()
+            )
+            timeout = max(timeout, 0.05)
+        if self.inotify is None:
+            sleep(self.interval if timeout is None else min(
+                timeout,
+                self.interval,
+            ))
+            return None
+        if timeout is None:
+            timeout = INOTIFY_RESCAN
+        for event in self.inotify.read(timeout=int(timeout * 1000)):
+            if event.mask & inotify_flags.IGNORED:
+                # Directory was removed, it will be re-watched if it's
+                # created again.
+                self.watched_dirs.pop(event.wd, None)
+        return None
+
+    def watch(self):
+        """ Yield file paths as they become ready. This never stops, unless
+            the caller stops iterating.
+        """
+        while True:
+            yield from self.ready_files()
+            self.wait()
+
+    def watch_dir(self, dirpath):
+        """ Add an inotify watch for a directory, if inotify is used. """
+        if self.inotify is None:
+            return None
+        if dirpath in self.watched_dirs.values():
+            return None
+        mask = (
+            inotify_flags.CLOSE_WRITE |
+            inotify_flags.CREATE |
+            inotify_flags.DELETE |
+            inotify_flags.MOVED_FROM |
+            inotify_flags.MOVED_TO
+        )
+        try:
+            wd = self.inotify.add_watch(dirpath, mask)
+        except OSError as ex:
+            debug_err('Unable to watch directory: {}\n{}'.format(dirpath, ex))
+            return None
+        self.watched_dirs[wd] = dirpath
+        return wd
@@ -34,11 +34,26 @@ VERSIONSTR = '{} v. {}'.format(NAME, VERSION)
 SCRIPT = os.path.split(os.path.abspath(sys.argv[0]))[1]
 SCRIPTDIR = os.path.abspath(sys.path[0])
 
+# Module to import for --importtime, and the budget in milliseconds.
+IMPORT_MODULE = 'tigertamer'
+IMPORT_BUDGET = 400
+# Modules that should never be imported by the console app.
+IMPORT_FORBIDDEN = ('lib.gui', 'lxml', 'tkinter')
+# Default file for --bench results, so versions can be compared with -c.
+BENCH_FILE = 'tigertamer_bench_{}.json'.format(tigertamer_version)
+# Default master file line counts, and runs for each one, for --bench.
+# These match test.benchmarks, which is only imported for --bench
+# (it imports the lxml modules).
+BENCH_LINES = (1000, 5000, 20000)
+BENCH_REPEAT = 3
+
 USAGESTR = """{versionstr}
     Runs tests using `green` and provides a little more info.
 
     Usage:
         {script} -h | -v
+        {script} -B [-c file] [-n nums] [-o file] [-t num]
+        {script} -i [-b ms]
         {script} [-d] [-s] [-r | -R]
         {script} [-d] [-s] [-r | -R] TESTS...
         {script} (-l | -L) [PATTERN...]
@@ -46,20 +61,56 @@ USAGESTR = """{versionstr}
     Options:
         PATTERN              : Regex/text pattern to match against test names.
         TESTS                : Test names for `green`.
+        -B,--bench           : Run benchmarks for each conversion phase,
+                               using generated Mozaik master files.
+        -b ms,--budget ms    : Import time budget for -i, in milliseconds.
+                               Default: {budget}
+        -c file,--compare file
+                             : Compare --bench results with results from
+                               a previous run.
         -d,--dryrun          : Just show test names.
         -h,--help            : Show this help message.
+        -i,--importtime      : Check the console import time for Tiger Tamer
+                               (like `python -X importtime`), and make sure
+                               the GUI/lxml modules are not imported.
         -L,--listall         : List all test names with their full name.
         -l,--list            : List all test cases/names.
+        -n nums,--lines nums : Comma-separated master file line counts
+                               for --bench.
+                               Default: {lines}
+        -o file,--output file
+                             : File to save --bench results to (JSON).
+                               Use - to not save them.
+                               Default: {benchfile}
         -r,--run-coverage    : Run coverage.
         -R,--quiet-coverage  : Run coverage without stdout output.
         -s,--stdout          : Allow stdout (removes -q from green args).
+        -t num,--times num   : Number of times to run each --bench size.
+                               The fastest time is used for each phase.
+                               Default: {repeat}
         -v,--version         : Show version.
-""".format(script=SCRIPT, versionstr=VERSIONSTR)
+""".format(
+    benchfile=BENCH_FILE,
+    budget=IMPORT_BUDGET,
+    lines=','.join(str(i) for i in BENCH_LINES),
+    repeat=BENCH_REPEAT,
+    script=SCRIPT,
+    versionstr=VERSIONSTR,
+)
 
 
 def main(argd):
     """ Main entry point, expects doctopt arg dict as argd. """
     # Use the test directory when no args are given.
+    if argd['--bench']:
+        return run_benchmarks(
+            sizes=parse_int_list(argd['--lines'], default=BENCH_LINES),
+            repeat=parse_int(argd['--times'], default=BENCH_REPEAT),
+            outfile=argd['--output'] or BENCH_FILE,
+            comparefile=argd['--compare'],
+        )
+    if argd['--importtime']:
+        return check_import_time(budget=parse_int(argd['--budget']))
     green_exe = get_green_exe()
     if argd['--list'] or argd['--listall']:
         userpats = [
@@ -84,6 +135,67 @@ def main(argd):
     return subprocess.run(cmd).returncode
 
 
+def check_import_time(
+        module=IMPORT_MODULE, budget=None, forbidden=IMPORT_FORBIDDEN):
+    """ Import a module with `python -X importtime`, and print the slowest
+        top-level imports.
+        Returns a non-zero exit status if the cumulative import time is
+        over `budget` milliseconds, or any `forbidden` modules were
+        imported.
+    """
+    budget = budget or IMPORT_BUDGET
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+    )
+    if proc.returncode != 0:
+        print_err(proc.stderr)
+        return proc.returncode
+    # Lines look like: 'import time: self [us] | cumulative | package'
+    # Nested imports are indented in the package column, and are listed
+    # before the module that imported them.
+    times = {}
+    total = 0
+    badmodules = []
+    for line in proc.stderr.splitlines():
+        try:
+            _, cumulative, name = line.split('|')
+            cumulative = int(cumulative)
+        except ValueError:
+            # Header line.
+            continue
+        modname = name.strip()
+        if any(
+                (modname == s) or modname.startswith(f'{s}.')
+                for s in forbidden):
+            badmodules.append(modname)
+        if name.startswith('   ') and not name.startswith('    '):
+            # Direct import, of whichever top-level module comes next.
+            times[modname] = cumulative / 1000
+        elif modname == module:
+            total = cumulative / 1000
+            break
+        elif not name.startswith('  '):
+            # Another top-level module, like `site`.
+            times.clear()
+
+    for modname in sorted(times, key=times.get, reverse=True)[:10]:
+        print('{:>8.1f}ms {}'.format(times[modname], C(modname, 'cyan')))
+    overbudget = total > budget
+    print(C(': ').join(
+        C('Import time for {}'.format(module), 'cyan'),
+        C(
+            '{:0.1f}ms / {}ms'.format(total, budget),
+            'red' if overbudget else 'green',
+            style='bright',
+        ),
+    ))
+    for modname in badmodules:
+        print_err(C('Imported a forbidden module: {}'.format(modname), 'red'))
+    return int(overbudget) + len(badmodules)
+
+
 def filter_test_info(patterns, test_info):
     """ Filter info returned from `load_test_info` using a list of compiled
         regex patterns. Only tests that match test method names, case names,
@@ -296,6 +408,29 @@ def parse_test_names(names):
     return sorted(fixed)
 
 
+def parse_int(s, default=None):
+    """ Parse an integer argument, raising InvalidArg for bad values.
+        If `s` is Falsey, `default` is returned.
+    """
+    if not s:
+        return default
+    try:
+        val = int(s)
+    except ValueError:
+        raise InvalidArg('Invalid number: {}'.format(s))
+    return val
+
+
+def parse_int_list(s, default=None):
+    """ Parse a comma-separated list of integers, raising InvalidArg for
+        bad values.
+        If `s` is Falsey, `default` is returned.
+    """
+    if not s:
+        return default
+    return tuple(parse_int(num) for num in s.split(',') if num.strip())
+
+
 def pats_search(patterns, s):
     """ Returns a list of pattern matches against `s` for all regex patterns
         in the `patterns` list.
@@ -366,6 +501,36 @@ def print_test_names(names):
     return 0 if names else 1
 
 
+def run_benchmarks(
+        sizes=BENCH_LINES, repeat=BENCH_REPEAT, outfile=BENCH_FILE,
+        comparefile=None):
+    """ Run the conversion phase benchmarks, save the results as JSON,
+        and compare them with previous results if `comparefile` is given.
+    """
+    from test.benchmarks import (
+        bench_phases,
+        load_results,
+        print_comparison,
+        save_results,
+    )
+    previous = None
+    if comparefile:
+        # Load it first, in case the same file is overwritten.
+        try:
+            previous = load_results(comparefile)
+        except (EnvironmentError, ValueError) as ex:
+            raise InvalidArg('Cannot load results: {}\n{}'.format(
+                comparefile,
+                ex,
+            ))
+    results = bench_phases(sizes=sizes, repeat=repeat)
+    if outfile != '-':
+        save_results(results, outfile)
+    if previous is not None:
+        print_comparison(results, previous)
+    return 0
+
+
 def try_repat(s, default=None):
     """ Try compiling a regex pattern.
         If `s` is Falsey, `default` is returned.
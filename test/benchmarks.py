@@ -0,0 +1,346 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" benchmarks.py
+    Benchmarks for TigerTamer.
+    Run from the TigerTamer directory with: python3 -m test.benchmarks
+    or: ./runtests.py --bench
+
+    -Christopher Welborn 10-16-2026
+"""
+import csv
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+from contextlib import redirect_stdout
+from datetime import datetime
+from io import StringIO
+from time import perf_counter, time
+from unittest import mock
+
+from colr import (
+    auto_disable as colr_auto_disable,
+    Colr as C,
+)
+
+from lib.util.archive import archive_file
+from lib.util.config import VERSION
+from lib.util.format import create_xml
+from lib.util.metrics import RunMetrics
+from lib.util.parser import (
+    MozaikMasterFile,
+    MozaikPartTree,
+    write_tiger_file,
+)
+
+colr_auto_disable()
+
+# Part counts to use when showing how something scales.
+SCALE_SIZES = (250, 500, 1000, 2000, 4000)
+
+# Master file line counts for the phase benchmarks.
+PHASE_SIZES = (1000, 5000, 20000)
+# Number of times to run each phase benchmark. The fastest run is kept.
+PHASE_REPEAT = 3
+# Phases that are timed by `bench_phases()`, in order.
+PHASES = (
+    'csv_parse',
+    'split_parts',
+    'into_width_files',
+    'combine_parts',
+    'create_xml',
+    'write_tiger_file',
+    'archive',
+)
+# Values for the synthetic master file generator.
+GEN_EXTRA = ('', '', '', 'x', 'Edge banded', 'Grain vertical')
+GEN_LENGTHS = (
+    10, 12.5, 14.75, 20.5, 22.25, 23.3125, 30, 34.5, 86.50001, 96,
+)
+GEN_TYPES = ('BR', 'TR', 'RS', 'LS', 'MR', 'FS', 'Drawer Front', 'Toe Kick')
+GEN_WIDTHS = (
+    0.75, 1, 1.25, 1.5, 1.75, 2, 2.25, 2.5, 3, 3.5, 4, 4.5, 5.25, 6,
+)
+
+
+def generate_master_lines(
+        count, seed=0, rooms=9, cabs=40, widths=GEN_WIDTHS):
+    """ Generate `count` realistic Mozaik master file lines.
+        Parts are spread across several rooms and cabinets
+        (like `R2:1&4(2) R5:3`), with quantity markers, many widths,
+        and some extra data. The part count matches the `no` string,
+        so nothing is "lost" like it sometimes is with Mozaik.
+        The same `seed` always generates the same lines.
+    """
+    rand = random.Random(seed)
+    lines = []
+    for _ in range(count):
+        roomnos = []
+        partcount = 0
+        for room in sorted(rand.sample(
+                range(1, rooms + 1),
+                rand.choice((1, 1, 1, 2, 3)))):
+            cabnos = []
+            for cab in sorted(rand.sample(
+                    range(1, cabs + 1),
+                    rand.choice((1, 1, 2, 3, 4, 8)))):
+                qty = rand.choice((1, 1, 1, 1, 2, 3))
+                partcount += qty
+                cabnos.append(str(cab) if qty == 1 else '{}({})'.format(
+                    cab,
+                    qty,
+                ))
+            roomnos.append('R{}:{}'.format(room, '&'.join(cabnos)))
+        lines.append(','.join((
+            str(partcount),
+            str(rand.choice(widths)),
+            str(rand.choice(GEN_LENGTHS)),
+            rand.choice(GEN_TYPES),
+            ' '.join(roomnos),
+            rand.choice(GEN_EXTRA),
+        )))
+    return lines
+
+
+def load_results(filepath):
+    """ Load results that were saved with `save_results()`. """
+    with open(filepath, 'r') as f:
+        return json.load(f)
+
+
+def print_comparison(results, previous):
+    """ Print the difference between phase timings in `results`, and
+        `previous` results (from `load_results()`).
+        Only line counts that are in both results are compared.
+    """
+    oldruns = {run['lines']: run for run in previous.get('runs', [])}
+    print(C(' ').join(
+        C('Compared to', 'cyan'),
+        C('v. {}'.format(previous.get('version', '?')), 'blue'),
+        C(previous.get('date', ''), 'blue'),
+    ))
+    for run in results['runs']:
+        oldrun = oldruns.get(run['lines'], None)
+        if oldrun is None:
+            continue
+        print(C('    {} lines:'.format(run['lines']), 'cyan'))
+        for phase in PHASES + ('total', ):
+            new = run['phases'].get(phase, None)
+            old = oldrun['phases'].get(phase, None)
+            if not (new and old):
+                continue
+            ratio = new / old
+            color = 'green' if ratio <= 1.05 else (
+                'yellow' if ratio <= 1.2 else 'red'
+            )
+            print('        {:<18} {:>9.4f}s -> {:>9.4f}s {}'.format(
+                phase,
+                old,
+                new,
+                C('{:>7.2f}x'.format(ratio), color),
+            ))
+    return 0
+
+
+def print_phases(run):
+    """ Print phase timings for a single run from `bench_phases()`. """
+    print(C(' ').join(
+        C('{} lines'.format(run['lines']), 'cyan'),
+        C('({} parts, {} width files):'.format(
+            run['parts'],
+            run['width_files'],
+        ), 'blue'),
+    ))
+    for phase in PHASES + ('total', ):
+        print('    {:<18} {:>9.4f}s'.format(phase, run['phases'][phase]))
+
+
+def run_phases(datpath, workdir, extra_data=False):
+    """ Convert a master file, one phase at a time, like Tiger Tamer does.
+        Returns (phase_times, part_count, width_file_count).
+    """
+    times = {}
+    outdir = os.path.join(workdir, 'output')
+    archdir = os.path.join(workdir, 'archive')
+    os.mkdir(outdir)
+
+    start = perf_counter()
+    with open(datpath) as f:
+        master = MozaikMasterFile(filepath=datpath)
+        for row in csv.reader(f):
+            master.parts.extend(
+                MozaikMasterFile.parse_row(row, split_parts=False)
+            )
+    times['csv_parse'] = perf_counter() - start
+
+    start = perf_counter()
+    parts = []
+    for part in master.parts:
+        parts.extend(part.split_parts())
+    master.parts = parts
+    master.count = sum(p.count for p in parts)
+    times['split_parts'] = perf_counter() - start
+
+    # Parts are combined while the width files are created, so the
+    # run metrics timers are used to separate the two.
+    metrics = RunMetrics()
+    with mock.patch('lib.util.parser.run_metrics', metrics):
+        mozfiles = master.into_width_files()
+    times['into_width_files'] = metrics.times.get('width_files', 0)
+    times['combine_parts'] = metrics.times.get('combine_parts', 0)
+    xmls = []
+    times['create_xml'] = time_func(
+        lambda: xmls.extend(
+            create_xml(m, extra_data=extra_data) for m in mozfiles
+        )
+    )
+    tigerpaths = []
+
+    def add_tigerpath(mozfile, tigerpath):
+        tigerpaths.append(tigerpath)
+        return 0
+
+    # Status messages would be printed in a terminal.
+    with redirect_stdout(StringIO()):
+        # The XML is already rendered, only writing is timed.
+        times['write_tiger_file'] = time_func(
+            lambda: [
+                write_tiger_file(
+                    mozfile,
+                    outdir,
+                    archive_dir=None,
+                    extra_data=extra_data,
+                    success_cb=add_tigerpath,
+                    xml=xml,
+                )
+                for mozfile, xml in zip(mozfiles, xmls)
+            ]
+        )
+        # Don't count benchmark files in the user's archive stats.
+        with mock.patch('lib.util.archive.config_increment'):
+            times['archive'] = time_func(
+                archive_file,
+                datpath,
+                archdir,
+                created_files=tigerpaths,
+            )
+    times['total'] = sum(times.values())
+    return times, len(parts), len(mozfiles)
+
+
+def save_results(results, filepath):
+    """ Save results from `bench_phases()` as JSON. """
+    with open(filepath, 'w') as f:
+        json.dump(results, f, indent=4, sort_keys=True)
+    print(C(': ').join(
+        C('Saved results', 'cyan'),
+        C(filepath, 'blue', style='bright'),
+    ))
+    return results
+
+
+def time_func(func, *args, **kwargs):
+    """ Call a function, and return the number of seconds it took. """
+    start = perf_counter()
+    func(*args, **kwargs)
+    return perf_counter() - start
+
+
+def tree_build_merge(parts):
+    """ Build a tree the old way, re-merging the whole tree for each part.
+    """
+    tree = MozaikPartTree({}, label='room')
+    for part in parts:
+        tree.update(part.tree())
+    return tree
+
+
+def tree_build_incremental(parts):
+    """ Build a tree by inserting each part into one mutable tree. """
+    tree = MozaikPartTree({}, label='room')
+    for part in parts:
+        part.add_to_tree(tree)
+    return tree
+
+
+def bench_tree_build(sizes=SCALE_SIZES):
+    """ Compare MozaikPartTree.update() against add_to_tree() for
+        increasing part counts.
+    """
+    print(C('Tree building (merge vs. incremental):', 'cyan'))
+    for size in sizes:
+        # Every line has at least one part.
+        master = MozaikMasterFile.from_lines(
+            generate_master_lines(size),
+            split_parts=True,
+        )
+        parts = master.parts[:size]
+        merged = time_func(tree_build_merge, parts)
+        incremental = time_func(tree_build_incremental, parts)
+        print('    {:>6} parts: {:>9.4f}s merge, {:>9.4f}s incremental'.format(
+            len(parts),
+            merged,
+            incremental,
+        ))
+    return 0
+
+
+def bench_phases(sizes=PHASE_SIZES, repeat=PHASE_REPEAT, seed=0):
+    """ Time each conversion phase for generated master files with
+        `sizes` lines. Each size is run `repeat` times, with a new master
+        file each time (archiving moves it), and the fastest time for each
+        phase is kept.
+        Returns a dict of results that can be saved as JSON.
+    """
+    results = {
+        'date': '{:%Y-%m-%d %H:%M:%S}'.format(datetime.now()),
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'repeat': repeat,
+        'runs': [],
+        'seed': seed,
+        'time': time(),
+        'version': VERSION,
+    }
+    rootdir = tempfile.mkdtemp(prefix='tigertamer_bench_')
+    try:
+        for size in sizes:
+            lines = generate_master_lines(size, seed=seed)
+            best = {}
+            for i in range(max(repeat, 1)):
+                workdir = os.path.join(rootdir, '{}_{}'.format(size, i))
+                # Master files are archived as <parent dir>__<name>.
+                jobdir = os.path.join(workdir, 'Job{}'.format(size))
+                os.makedirs(jobdir)
+                datpath = os.path.join(jobdir, 'bench.dat')
+                with open(datpath, 'w') as f:
+                    f.write('\n'.join(lines))
+                    f.write('\n')
+                times, partcount, filecount = run_phases(datpath, workdir)
+                for phase, seconds in times.items():
+                    best[phase] = min(best.get(phase, seconds), seconds)
+            run = {
+                'lines': size,
+                'parts': partcount,
+                'phases': best,
+                'width_files': filecount,
+            }
+            print_phases(run)
+            results['runs'].append(run)
+    finally:
+        shutil.rmtree(rootdir, ignore_errors=True)
+    return results
+
+
+def main():
+    bench_tree_build()
+    bench_phases()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -7,8 +7,11 @@
     -Christopher Welborn 02-24-2019
 """
 import os
+import subprocess
 import sys
+import tempfile
 import unittest
+from unittest import mock
 
 from colr import Colr as C
 from printdebug import DebugColrPrinter
@@ -17,12 +20,25 @@ from ..lib.util.archive import (
     Archive,
     ArchiveFile,
     archive_split_char,
+    FileNameIndex,
+    FinishedFile,
+    open_new_file,
+)
+from ..lib.util.cache import (
+    ConversionCache,
+    DatInfoCache,
 )
 from ..lib.util.config import (
     NotSet,
 )
+from ..lib.util import metrics
+from ..lib.util.metrics import RunMetrics
 from ..lib.util.parser import (
+    DatFileScanner,
     MozaikMasterFile,
+    MozaikPartTree,
+    get_dat_file_info,
+    parse_cab_no,
 )
 
 from ..test import (
@@ -243,6 +259,81 @@ class MozaikMasterFileTests(unittest.TestCase):
             )
             debug('Passed: {}'.format(testitem.desc))
 
+    def test_width_files_streaming(self):
+        """ width_files_from_parts should work with a generator of parts. """
+        for testitem in self.testdata_combined:
+            parts = (
+                part
+                for line in testitem.lines
+                for part in MozaikMasterFile.parse_row(line.split(','))
+            )
+            mozfile = MozaikMasterFile.width_files_from_parts(
+                parts,
+                filepath='Test Data.dat',
+            )[0]
+            self.assertPartListEqual(
+                mozfile.parts,
+                testitem.expected,
+                msg='width_files_from_parts() failed to combine parts.',
+                desc=testitem.desc,
+            )
+            self.assertEqual(
+                mozfile.count,
+                sum(p.count for p in testitem.expected),
+                msg='width_files_from_parts() set the wrong count.',
+            )
+
+    def test_tree_incremental(self):
+        """ tree() should match a tree built with MozaikPartTree.update(). """
+        lines = [
+            line
+            for testitem in self.testdata_combined
+            for line in testitem.lines
+        ]
+        lines.extend(self.testdata)
+        for split_parts in (True, False):
+            mfile = MozaikMasterFile.from_lines(
+                lines,
+                split_parts=split_parts,
+                filepath='Test Data.dat',
+            )
+            merged = MozaikPartTree({}, label='room')
+            for part in mfile.parts:
+                merged.update(part.tree())
+            self.assertListEqual(
+                mfile.tree().to_lines(),
+                merged.to_lines(),
+                msg='Incremental tree does not match merged tree.',
+            )
+
+
+class ParseCabNoTests(unittest.TestCase):
+    def test_parse_cab_no(self):
+        """ parse_cab_no should parse rooms, cabs, and (n) multipliers. """
+        cases = {
+            'R1:1': (('R1', '1', 1), ),
+            '2(3)': (('R1', '2(3)', 3), ),
+            'R5:1&2&3 R7:1(2)': (
+                ('R5', '1', 1),
+                ('R5', '2', 1),
+                ('R5', '3', 1),
+                ('R7', '1(2)', 2),
+            ),
+        }
+        for no, expected in cases.items():
+            self.assertTupleEqual(
+                parse_cab_no(no),
+                expected,
+                msg='Failed to parse: {!r}'.format(no),
+            )
+        info = parse_cab_no.cache_info()
+        parse_cab_no('R5:1&2&3 R7:1(2)')
+        self.assertEqual(
+            parse_cab_no.cache_info().hits,
+            info.hits + 1,
+            msg='Parsed cab numbers were not cached.',
+        )
+
 
 class ArchiveTestsBase(unittest.TestCase):
     """ Common data/tests for Archive/ArchiveFile. """
@@ -292,5 +383,230 @@ class ArchiveFileTests(ArchiveTestsBase):
             )
 
 
+class ConversionCacheTests(unittest.TestCase):
+    def test_reuse(self):
+        """ ConversionCache should reuse tiger files for unchanged files. """
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cachefile = os.path.join(tmpdir, 'cache.json')
+            datpath = os.path.join(tmpdir, 'test_file.dat')
+            tigerpath = os.path.join(tmpdir, 'test_file.tiger')
+            for filepath in (datpath, tigerpath):
+                with open(filepath, 'w') as f:
+                    f.write('test')
+            cache = ConversionCache(filepath=cachefile)
+            self.assertIsNone(
+                cache.reuse(datpath, tmpdir),
+                msg='New file was found in the cache.',
+            )
+            cache.add(datpath, [tigerpath])
+            self.assertTrue(cache.save(), msg='Cache was not saved.')
+            cache = ConversionCache(filepath=cachefile)
+            self.assertListEqual(
+                cache.reuse(datpath, tmpdir),
+                [tigerpath],
+                msg='Unchanged file was not found in the cache.',
+            )
+            otherdir = os.path.join(tmpdir, 'Other Job')
+            os.mkdir(otherdir)
+            otherpath = os.path.join(otherdir, 'Other Job.dat')
+            with open(otherpath, 'w') as f:
+                f.write('test')
+            self.assertIsNone(
+                cache.reuse(otherpath, tmpdir),
+                msg='Cache was used for a file with different tiger names.',
+            )
+            nosplit = ConversionCache(filepath=cachefile, split_parts=False)
+            self.assertIsNone(
+                nosplit.reuse(datpath, tmpdir),
+                msg='Cache was used with different settings.',
+            )
+            with open(datpath, 'a') as f:
+                f.write('changed')
+            cache = ConversionCache(filepath=cachefile)
+            self.assertIsNone(
+                cache.reuse(datpath, tmpdir),
+                msg='Changed file was found in the cache.',
+            )
+
+
+class DatFileScannerTests(unittest.TestCase):
+    def test_info_cache(self):
+        """ DatFileScanner should not open unchanged files twice. """
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cachefile = os.path.join(tmpdir, 'datinfo.json')
+            datdir = os.path.join(tmpdir, 'job')
+            os.mkdir(datdir)
+            datpath = os.path.join(datdir, 'test_file.dat')
+            with open(datpath, 'w') as f:
+                f.write('1,2,3,Top,R1:1,\n1,1.5,3,Top,R1:2,\n')
+            for opened, cached in ((1, 0), (0, 1)):
+                scanner = DatFileScanner(
+                    info_cache=DatInfoCache(filepath=cachefile),
+                )
+                self.assertListEqual(
+                    scanner.scan(tmpdir),
+                    [datpath],
+                    msg='Valid file was not found.',
+                )
+                self.assertEqual(
+                    (scanner.opened, scanner.cached),
+                    (opened, cached),
+                    msg='Info cache was not used.',
+                )
+                scanner.info_cache.save()
+            self.assertEqual(
+                scanner.info_cache.load()[datpath]['columns'],
+                6,
+                msg='Bad column count.',
+            )
+            info = get_dat_file_info(datpath)
+            self.assertEqual(info['lines'], 2, msg='Bad line count.')
+            self.assertListEqual(
+                info['widths'],
+                ['1.5', '2'],
+                msg='Bad widths.',
+            )
+            self.assertDictEqual(
+                info['counts'],
+                {'1.5': 1, '2': 1},
+                msg='Bad part counts.',
+            )
+
+
+class FileNameIndexTests(unittest.TestCase):
+    def test_open_new_file(self):
+        """ open_new_file should never replace existing files. """
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filepath = os.path.join(tmpdir, 'test_file.tiger')
+            with open(filepath, 'w') as f:
+                f.write('original')
+            name_index = FileNameIndex(tmpdir)
+            self.assertIn(filepath, name_index, msg='File was not indexed.')
+            # Created after the directory was listed.
+            with open(os.path.join(tmpdir, 'test_file(1).tiger'), 'w'):
+                pass
+            expected = [
+                os.path.join(tmpdir, 'test_file(2).tiger'),
+                os.path.join(tmpdir, 'test_file(3).tiger'),
+            ]
+            for expectedpath in expected:
+                newpath, f = open_new_file(filepath, name_index=name_index)
+                with f:
+                    f.write('new')
+                self.assertEqual(newpath, expectedpath, msg='Bad new name.')
+                self.assertIn(newpath, name_index, msg='Name was not added.')
+            with open(filepath, 'r') as f:
+                self.assertEqual(
+                    f.read(),
+                    'original',
+                    msg='Existing file was replaced.',
+                )
+
+
+class FinishedFileTests(unittest.TestCase):
+    def test_save_created(self):
+        """ FinishedFile should append created files to it's .info file. """
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filepath = os.path.join(tmpdir, 'input', 'test_file.dat')
+            ffile = FinishedFile(filepath, tmpdir, created_files=['a.tiger'])
+            for created in (['b.tiger'], ['a.tiger'], ['c.tiger']):
+                ffile.add_created(created)
+            with open(ffile.info_path, 'r') as f:
+                lines = f.read().splitlines()
+            self.assertListEqual(
+                lines,
+                ['a.tiger', 'b.tiger', 'c.tiger'],
+                msg='Created files were not appended once each.',
+            )
+            # Duplicates from other runs are ignored when reading.
+            with open(ffile.info_path, 'a') as f:
+                f.write('b.tiger\n')
+            archfile = ArchiveFile(ffile.archived_path, tmpdir)
+            self.assertListEqual(
+                archfile.created_files,
+                ['a.tiger', 'b.tiger', 'c.tiger'],
+                msg='Duplicate created files were not ignored.',
+            )
+            # Duplicates are compacted when a FinishedFile loads them.
+            ffile = FinishedFile(filepath, tmpdir, created_files=['d.tiger'])
+            with open(ffile.info_path, 'r') as f:
+                lines = f.read().splitlines()
+            self.assertListEqual(
+                lines,
+                ['a.tiger', 'b.tiger', 'c.tiger', 'd.tiger'],
+                msg='Created files were not compacted.',
+            )
+
+
+class ImportTests(unittest.TestCase):
+    def test_console_imports(self):
+        """ Console mode should not import the GUI, tkinter, or lxml. """
+        forbidden = ('lib.gui', 'lxml', 'tkinter')
+        proc = subprocess.run(
+            [
+                sys.executable,
+                '-c',
+                '; '.join((
+                    'import sys',
+                    'import tigertamer',
+                    'print(\'\\n\'.join(sys.modules))',
+                )),
+            ],
+            cwd=os.path.dirname(os.path.abspath(TESTDIR)),
+            stdout=subprocess.PIPE,
+            universal_newlines=True,
+        )
+        self.assertEqual(proc.returncode, 0, msg='Failed to import.')
+        imported = [
+            s
+            for s in proc.stdout.splitlines()
+            if s.startswith(forbidden)
+        ]
+        self.assertListEqual(
+            imported,
+            [],
+            msg='Console mode imported GUI/lxml modules.',
+        )
+
+
+class RunMetricsTests(unittest.TestCase):
+    def test_nested_timers(self):
+        """ RunMetrics timers should not count time from nested timers. """
+        # perf_counter() values, in the order the timers ask for them.
+        clock = [
+            0,  # RunMetrics()
+            1,  # outer start
+            2,  # inner start
+            5,  # inner end
+            6, 7,  # items, first item
+            8, 10,  # items, second item
+            11, 11,  # items, exhausted
+            20,  # outer end
+            30,  # to_dict()
+        ]
+        with mock.patch.object(metrics, 'perf_counter', side_effect=clock):
+            runmetrics = RunMetrics()
+            with runmetrics.timer('outer'):
+                with runmetrics.timer('inner'):
+                    pass
+                for _ in runmetrics.timed_iter('items', range(2)):
+                    pass
+            info = runmetrics.to_dict()
+        self.assertDictEqual(
+            info['times'],
+            {'inner': 3, 'items': 3, 'outer': 13},
+            msg='Timers counted time from nested timers.',
+        )
+        self.assertEqual(info['total_secs'], 30, msg='Bad total time.')
+        runmetrics.count('parts', 5)
+        runmetrics.merge({'counts': {'parts': 2}, 'times': {'inner': 1}})
+        self.assertEqual(
+            runmetrics.counts['parts'],
+            7,
+            msg='Bad merged count.',
+        )
+        self.assertEqual(runmetrics.times['inner'], 4, msg='Bad merged time.')
+
+
 if __name__ == '__main__':
     unittest.main(argv=sys.argv, verbosity=2)
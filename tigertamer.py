@@ -26,8 +26,12 @@
     -Christopher Welborn 12-15-2018
 """
 
+import csv
 import os
+import shutil
+import signal
 import sys
+import tempfile
 from time import time
 
 from colr import (
@@ -47,11 +51,14 @@ from lib.util.config import (
 )
 from lib.util.archive import (
     Archive,
+    FileNameIndex,
+    forget_finished_file,
     list_archive,
 )
-from lib.util.format import (
-    TigerFile,
-    list_labelconfig,
+from lib.util.cache import ConversionCache
+from lib.util.metrics import (
+    METRICSFILE,
+    run_metrics,
 )
 from lib.util.logger import (
     debug,
@@ -59,22 +66,17 @@ from lib.util.logger import (
     set_debug_mode,
     status,
 )
-from lib.util.preview import (
-    LargeFileError,
-    TigerFiles,
-    check_file,
-)
-from lib.gui.main import (
-    list_funcs,
-    load_gui,
-)
 from lib.util.parser import (
     MozaikMasterFile,
-    create_xml,
+    convert_moz_files,
+    get_moz_file_paths,
     get_tiger_files,
-    load_moz_files,
+    load_moz_file,
+    plan_moz_files,
     write_tiger_file,
 )
+# The GUI (tkinter), preview, and format (lxml) modules are imported only
+# when they are needed, so console runs start fast.
 
 colr_auto_disable()
 
@@ -89,16 +91,19 @@ USAGESTR = """{versionstr}
 
     Usage:
         {script} (-F | -h | -L | -v) [-D]
-        {script} -f func [-e] [-s] [-D]
+        {script} -f func [-e] [-s] [--profile=type] [-D]
         {script} -g [-e] [-r] [-s] [-D]
         {script} [-g] -A [-D]
         {script} (-u | -U) [-a dir | ARCHIVE_FILE...] [-D]
         {script} [-g] (-p | -V) FILE... [-D]
         {script} (-m | -M | -t | -T) FILE... [-D]
         {script} [FILE...] [-e] [-i dir...] [-I text...]
-                      [-n] [-s] [-D]
+                      [-n] [-s] [--stats] [--profile=type] [-D]
         {script} [FILE...] [-e] [-i dir...] [-I text...]
-                      [-o dir [-a dir]] [-s] [-D]
+                      [-o dir [-a dir]] [-j num] [-s] [--force]
+                      [--stats] [--profile=type] [-D]
+        {script} [FILE...] -w [-e] [-i dir...] [-I text...]
+                      [-o dir [-a dir]] [-s] [--force] [--stats] [-D]
 
     Options:
         ARCHIVE_FILE          : One or more archived file paths to unarchive.
@@ -115,6 +120,9 @@ USAGESTR = """{versionstr}
         -F,--functions        : List all available functions for -f and exit.
         -f name, --func name  : Run a function from WinMain for debugging.
                                 This automatically implies -g,--gui.
+        --force               : Convert all master files, even if the same
+                                file was already converted with the same
+                                settings.
         -g,--gui              : Load the Tiger Tamer GUI.
         -h,--help             : Show this help message.
         -I str,--IGNORE str   : One or more strings to ignore when looking
@@ -123,18 +131,39 @@ USAGESTR = """{versionstr}
                                 for mozaik files.
                                 The output and archive directories are
                                 included automatically.
+        -j num,--jobs num     : Number of master files to convert at once,
+                                using worker processes.
+                                Use 0 for one per CPU.
+                                Default: 1
         -L,--labelconfig      : Print label config and exit.
         -M,--MASTERFILE       : Like -m, but separate into width files first.
         -m,--masterfile       : Parse, split parts, combine parts, and then
                                 output another Mozaik master file (.dat) to
                                 stdout.
-        -n,--namesonly        : Just show which files would be generated.
+        -n,--namesonly        : Just show which files would be generated,
+                                and the total part quantity for each one.
         -o dir,--output dir   : Output directory.
                                 Use - for stdout output.
         -p,--preview          : Preview output for a Mozaik (.dat) file.
                                 This will not create any Tiger (.tiger) files.
+        --profile=type        : Profile the conversion (or -f function),
+                                and save reports next to the log file.
+                                Types: cpu, mem, or all.
+                                Using --profile alone means cpu.
+                                Unless -o is given, tiger files are
+                                written to a temporary directory and
+                                removed, and -a can't be used.
+                                Master files are not archived without -a.
+                                Files are converted one at a time (-j is
+                                ignored), because worker processes are
+                                not profiled.
+                                With -f, the GUI settings are not saved.
         -r,--run              : Automatically run with settings in config.
         -s,--nosplit          : Do not split parts into single line items.
+        --stats               : Show timings and counts for each phase of
+                                the conversion when it's done.
+                                They are always saved in:
+                                {metricsfile}
         -T,--TREE             : Like -t, but separate into width files first.
                                 This adjusts the tree to width-first.
         -t,--tree             : Print parts in tree-form.
@@ -144,16 +173,27 @@ USAGESTR = """{versionstr}
         -V,--view             : View a formatted .tiger file in the console,
                                 or with the GUI if -g is also used.
         -v,--version          : Show version.
-""".format(author=AUTHOR, script=SCRIPT, versionstr=VERSIONSTR)
+        -w,--watch            : Keep running, and convert new master files
+                                as soon as they are done being written to
+                                the input directories.
+""".format(
+    author=AUTHOR,
+    metricsfile=METRICSFILE,
+    script=SCRIPT,
+    versionstr=VERSIONSTR,
+)
 
 
-def main(argd):
+def main(argd, save_gui_config=True):
     """ Main entry point, parses arguments and dispatches accordingly.
         Arguments:
-            argd  : Docopt arg dict.
+            argd             : Docopt arg dict.
+            save_gui_config  : Whether the GUI saves it's settings on exit.
     """
     set_debug_mode(argd['--debug'])
     debug('Debugging enabled.')
+    if argd['--profile']:
+        return profile_main(argd)
     # Get input paths, with no blanks (mainly for testing error messages).
     argd['FILE'] = [s for s in argd['FILE'] if s.strip()]
     inpaths = argd['FILE'] or config_get('dat_dir', [])
@@ -194,6 +234,7 @@ def main(argd):
             # when viewing/previewing files.
             inpaths = config_get('dat_dir', [])
             debug('Input paths reloaded/saved: {}'.format(inpaths))
+        from lib.gui.main import load_gui
         return load_gui(
             auto_exit=config_get('auto_exit', False),
             auto_run=argd['--run'],
@@ -214,6 +255,7 @@ def main(argd):
             run_function=argd['--func'],
             tiger_files=argd['FILE'] if argd['--view'] else None,
             preview_files=argd['FILE'] if argd['--preview'] else None,
+            save_config=save_gui_config,
         )
 
     # Console mode, need a lock.
@@ -229,10 +271,12 @@ def main(argd):
 
     if argd['--functions']:
         # List functions available for -f.
+        from lib.gui.main import list_funcs
         return list_funcs()
 
     if argd['--labelconfig']:
         # List label config being used.
+        from lib.util.format import list_labelconfig
         return list_labelconfig()
 
     if argd['--masterfile'] or argd['--MASTERFILE']:
@@ -268,27 +312,107 @@ def main(argd):
     # Run in console mode.
     if not inpaths:
         raise InvalidArg('No input files/directories!')
+    cache = None
+    if not (argd['--force'] or argd['--namesonly'] or (outdir == '-')):
+        cache = ConversionCache(
+            extra_data=argd['--extra'],
+            split_parts=not argd['--nosplit'],
+        )
+    if argd['--watch']:
+        return watch_files(
+            inpaths,
+            outdir,
+            archive_dir=archdir,
+            ignore_dirs=ignore_dirs,
+            ignore_strs=ignore_strs,
+            split_parts=not argd['--nosplit'],
+            extra_data=argd['--extra'],
+            cache=cache,
+            show_stats=argd['--stats'],
+        )
+    if argd['--namesonly']:
+        return plan_files(
+            inpaths,
+            outdir,
+            ignore_dirs=ignore_dirs,
+            ignore_strs=ignore_strs,
+            show_stats=argd['--stats'],
+        )
+    jobs = parse_jobs(argd['--jobs'])
 
     time_start = time()
+    run_metrics.reset()
 
-    mozfiles = load_moz_files(
+    datpaths = get_moz_file_paths(
         inpaths,
         ignore_dirs=ignore_dirs,
         ignore_strs=ignore_strs,
-        split_parts=not argd['--nosplit'],
     )
-
     parentfiles = set()
+    if cache is not None:
+        # Skip master files that were already converted.
+        cachedpaths = {
+            filepath
+            for filepath in datpaths
+            if cache.reuse(filepath, outdir, archive_dir=archdir) is not None
+        }
+        parentfiles.update(cachedpaths)
+        datpaths = [s for s in datpaths if s not in cachedpaths]
+
+    if jobs < 2:
+        # The paths are already resolved, don't scan them again.
+        converted = (
+            (mfile, None)
+            for datpath in datpaths
+            for mfile in load_moz_file(
+                datpath,
+                split_parts=not argd['--nosplit'],
+            )
+        )
+    else:
+        # Parse/split/combine/render in worker processes. Writing and
+        # archiving is still done here, in order.
+        converted = convert_moz_files(
+            datpaths,
+            jobs=jobs,
+            split_parts=not argd['--nosplit'],
+            extra_data=argd['--extra'],
+        )
+
+    mozfiles = []
+    # Existing tiger file names, listed once, for naming new files.
+    name_index = FileNameIndex(outdir)
+    # Tiger files created for each master file, for the cache.
+    createdfiles = {}
+    failedfiles = set()
+
+    def add_created_file(mozfile, tigerpath):
+        createdfiles.setdefault(mozfile.parent_file, []).append(tigerpath)
+        return 0
+
+    def add_failed_file(mozfile, msg):
+        failedfiles.add(mozfile.parent_file)
+        return 1
+
     errs = 0
-    for mfile in mozfiles:
+    for mfile, xml in converted:
+        mozfiles.append(mfile)
         parentfiles.add(mfile.parent_file)
         errs += handle_moz_file(
             mfile,
             outdir,
-            names_only=argd['--namesonly'],
             archive_dir=archdir,
             extra_data=argd['--extra'],
+            xml=xml,
+            error_cb=add_failed_file,
+            success_cb=add_created_file,
+            name_index=name_index,
         )
+    if cache is not None:
+        for parentfile, tigerpaths in createdfiles.items():
+            if parentfile not in failedfiles:
+                cache.add(parentfile, tigerpaths)
+        cache.save()
 
     parentlen = len(parentfiles)
     status(
@@ -307,6 +431,7 @@ def main(argd):
     )
     for pfile in sorted(parentfiles):
         debug('Parent file: {}'.format(pfile))
+    save_metrics(show_stats=argd['--stats'])
 
     config_increment(
         master_files=parentlen,
@@ -345,15 +470,18 @@ def confirm(s, default=False):
 
 def handle_moz_file(
         mozfile, outdir,
-        archive_dir=None, names_only=False, extra_data=False):
-    """ Handle the processing of one MozaikFile. """
-    tigerpath = os.path.join(outdir, mozfile.filepath)
-
-    if names_only:
-        print(tigerpath)
-        return 0
-    elif outdir in (None, '-'):
-        print(create_xml(mozfile, extra_data=extra_data))
+        archive_dir=None, extra_data=False, xml=None,
+        error_cb=None, success_cb=None, name_index=None):
+    """ Handle the processing of one MozaikFile.
+        If `xml` is given, it was already rendered by a worker process.
+        Callbacks and the FileNameIndex are passed to `write_tiger_file()`
+        when a tiger file is written.
+    """
+    if outdir in (None, '-'):
+        if xml is None:
+            from lib.util.format import create_xml
+            xml = create_xml(mozfile, extra_data=extra_data)
+        print(xml)
         return 0
 
     return write_tiger_file(
@@ -361,6 +489,10 @@ def handle_moz_file(
         outdir,
         archive_dir=archive_dir,
         extra_data=extra_data,
+        xml=xml,
+        error_cb=error_cb,
+        success_cb=success_cb,
+        name_index=name_index,
     )
 
 
@@ -369,8 +501,60 @@ def options_are_set(*args):
     return all(((s and s != '-') for s in args))
 
 
+def parse_jobs(s):
+    """ Parse the --jobs argument into a worker count.
+        Returns 1 if no value was given, or the CPU count for 0.
+        Raises InvalidArg for bad values.
+    """
+    if s is None:
+        return 1
+    try:
+        jobs = int(s)
+    except ValueError:
+        raise InvalidArg('not a number for --jobs: {}'.format(s))
+    if jobs < 0:
+        raise InvalidArg('--jobs must be 0 or more, got: {}'.format(jobs))
+    return jobs or (os.cpu_count() or 1)
+
+
+def plan_files(
+        inpaths, outdir, ignore_dirs=None, ignore_strs=None,
+        show_stats=False):
+    """ Print the tiger files that would be created, and the total part
+        quantity for each one, without converting anything.
+        The quantity is not the number of (combined) parts in the file.
+        Returns an exit status code (the number of invalid master files).
+    """
+    run_metrics.reset()
+    plans = plan_moz_files(
+        inpaths,
+        ignore_dirs=ignore_dirs,
+        ignore_strs=ignore_strs,
+    )
+    errs = 0
+    for datpath, tigernames, error in plans:
+        if error:
+            print_err('Invalid master file: {}\n{}'.format(datpath, error))
+            errs += 1
+            continue
+        for tigername, quantity in tigernames:
+            print('{}: quantity {}'.format(
+                os.path.join(outdir, tigername),
+                quantity,
+            ))
+            run_metrics.count('predicted_quantity', quantity)
+            run_metrics.count('tiger_files')
+    save_metrics(show_stats=show_stats)
+    return errs
+
+
 def preview_file(filepath):
     """ Preview a Mozaik file as a Tiger file. """
+    from lib.util.preview import (
+        LargeFileError,
+        TigerFiles,
+        check_file,
+    )
     try:
         check_file(filepath)
     except LargeFileError as ex:
@@ -389,6 +573,54 @@ def preview_files(filepaths):
     return sum(preview_file(s) for s in filepaths)
 
 
+def profile_main(argd):
+    """ Run `main()` with a CPU and/or memory profiler.
+        Unless an output directory was given on the command line, tiger
+        files are written to a temporary directory (removed afterwards),
+        even for GUI functions (-f).
+        Master files are only archived if an archive directory was given,
+        so production files can be profiled safely.
+        The conversion cache and worker processes are not used, and the
+        GUI doesn't save it's settings (like the temporary directory).
+    """
+    from lib.util.profiler import (
+        PROFILE_TYPES,
+        profiled,
+    )
+    kind = argd['--profile']
+    if kind not in PROFILE_TYPES:
+        raise InvalidArg('invalid type for --profile: {} (use: {})'.format(
+            kind,
+            ', '.join(sorted(PROFILE_TYPES)),
+        ))
+    use_tmpdir = not (argd['--output'] or argd['--namesonly'])
+    if use_tmpdir and argd['--archive'] not in (None, '-'):
+        # The .info files would list tiger files that were removed.
+        raise InvalidArg('--archive needs --output when profiling.')
+    argd['--profile'] = None
+    argd['--force'] = True
+    # The profilers can't see worker processes.
+    argd['--jobs'] = None
+    tmpdir = None
+    if use_tmpdir:
+        tmpdir = tempfile.mkdtemp(prefix='tigertamer_profile_')
+        debug('Profiling with a temporary output dir: {}'.format(tmpdir))
+        argd['--output'] = tmpdir
+    if not argd['--archive']:
+        # Don't archive, but still ignore the configured archive dir, so
+        # archived master files aren't converted.
+        archdir = config_get('archive_dir', './tigertamer_archive')
+        if archdir and (archdir != '-'):
+            argd['--ignore'].append(archdir)
+        argd['--archive'] = '-'
+    try:
+        with profiled(kind):
+            return main(argd, save_gui_config=False)
+    finally:
+        if tmpdir is not None:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+
 def remove_tiger_files(outdir):
     """ Deletes all .tiger files in `outdir`. """
     if not os.path.exists(outdir):
@@ -429,6 +661,16 @@ def remove_tiger_files(outdir):
     return errs
 
 
+def save_metrics(show_stats=False):
+    """ Save the run metrics, and print a summary if `show_stats` is
+        truthy.
+    """
+    run_metrics.save()
+    if show_stats:
+        for line in run_metrics.summary_lines():
+            print(line)
+
+
 def unarchive(datdir, archdir=None, filepaths=None, remove_tiger_files=False):
     """ Unarchive all dat files in `archdir`, and put them in `datdir`. """
     if not (archdir or filepaths):
@@ -514,6 +756,7 @@ def view_tigerfile(filepath):
         raise ValueError('No filepath provided!')
     if not filepath.lower().endswith('.tiger'):
         raise InvalidArg('not a valid tiger file: {}'.format(filepath))
+    from lib.util.format import TigerFile
     tf = TigerFile.from_file(filepath)
     return 0 if tf.print() else 1
 
@@ -548,6 +791,95 @@ def view_tree_files(filepaths, separate_widths=False):
     )
 
 
+def watch_files(
+        inpaths, outdir, archive_dir=None, ignore_dirs=None, ignore_strs=None,
+        split_parts=True, extra_data=False, cache=None, show_stats=False):
+    """ Watch input files/directories, and convert new master files as soon
+        as they are complete. This runs until it is interrupted.
+        If a ConversionCache is given, unchanged master files are not
+        converted again.
+        Run metrics are saved (and shown, with `show_stats`) for each
+        master file.
+    """
+    from lib.util.watcher import DatWatcher
+    watcher = DatWatcher(
+        inpaths,
+        ignore_dirs=ignore_dirs,
+        ignore_strs=ignore_strs,
+    )
+
+    def stop_watching(signum, frame):
+        # Exit like Ctrl+C does (releasing the lock) when a service manager
+        # or `kill` stops the watcher.
+        raise KeyboardInterrupt()
+
+    signal.signal(signal.SIGTERM, stop_watching)
+    status('Watching', ', '.join(inpaths))
+    for filepath in watcher.watch():
+        time_start = time()
+        run_metrics.reset()
+        if cache is not None:
+            # The key for an earlier export to this path is stale.
+            cache.forget(filepath)
+            if cache.reuse(filepath, outdir, archive_dir=archive_dir):
+                cache.save()
+                save_metrics(show_stats=show_stats)
+                # The same path may be exported again while watching.
+                forget_finished_file(filepath)
+                continue
+        try:
+            mozfiles = load_moz_file(filepath, split_parts=split_parts)
+        except (csv.Error, OSError, ValueError) as ex:
+            # The watcher won't try it again until it changes.
+            print_err('Cannot load master file: {}\n{}'.format(filepath, ex))
+            continue
+        tigerpaths = []
+
+        def add_created_file(mozfile, tigerpath):
+            tigerpaths.append(tigerpath)
+            return 0
+
+        # Files may be removed from the output dir while watching, so it's
+        # listed again for each master file.
+        name_index = FileNameIndex(outdir)
+        errs = sum(
+            handle_moz_file(
+                mozfile,
+                outdir,
+                archive_dir=archive_dir,
+                extra_data=extra_data,
+                error_cb=lambda mozfile, msg: 1,
+                success_cb=add_created_file,
+                name_index=name_index,
+            )
+            for mozfile in mozfiles
+        )
+        if (cache is not None) and tigerpaths and not errs:
+            cache.add(filepath, tigerpaths)
+            cache.save()
+        status(
+            C(' ').join(
+                C('Finished', 'cyan'),
+                C(filepath, 'blue', style='bright'),
+                C(' ').join(
+                    C(errs, 'blue', style='bright'),
+                    C('error' if errs == 1 else 'errors', 'cyan'),
+                ).join('(', ')', style='bright'),
+            )
+        )
+        save_metrics(show_stats=show_stats)
+        # The same path may be exported again while watching.
+        forget_finished_file(filepath)
+        if mozfiles:
+            config_increment(
+                master_files=1,
+                tiger_files=len(mozfiles),
+                runtime_secs=time() - time_start,
+                default=0,
+            )
+    return 0
+
+
 class InvalidArg(ValueError):
     """ Raised when the user has used an invalid argument. """
     def __init__(self, msg=None):
@@ -569,10 +901,13 @@ class InvalidConfig(InvalidArg):
 def entry_point(argv=None):
     """ Actual entry point for execution, wrapped in a function for testing.
     """
+    argv = argv or sys.argv[1:]
+    # --profile has an optional type, which docopt doesn't support.
+    argv = ['--profile=cpu' if s == '--profile' else s for s in argv]
     try:
         mainret = main(docopt(
             USAGESTR,
-            argv=argv or sys.argv[1:],
+            argv=argv,
             version=VERSIONSTR,
             script=SCRIPT,
         ))